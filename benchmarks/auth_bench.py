@@ -0,0 +1,51 @@
+"""Microbenchmark of the per-request token check
+
+    python benchmarks/auth_bench.py [--rounds 20000]
+
+"before" is the old path: jwt.decode with the key given as a string, so the key is
+rebuilt and every registered claim validated on each call. "after" is
+tokens.verify_access_token with the key set parsed once. Neither includes the
+user lookup that followed, the old path always needed one (by email) while the
+new one is served from the user cache by id, or skipped with AUTH_STATELESS.
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-benchmark-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from jose import jwt  # noqa: E402
+
+import tokens  # noqa: E402
+
+
+def before(rounds: int) -> float:
+    expire = datetime.now(timezone.utc) + timedelta(minutes=30)
+    token = jwt.encode({"exp": expire, "sub": "reader@example.com"}, tokens.SECRET_KEY, algorithm=tokens.ALGORITHM)
+    return timeit.timeit(
+        lambda: jwt.decode(token, tokens.SECRET_KEY, algorithms=[tokens.ALGORITHM]).get("sub"), number=rounds
+    )
+
+
+def after(rounds: int) -> float:
+    tokens.load_key_set()
+    token = tokens.create_access_token(1, 0, "reader@example.com", "reader")
+    return timeit.timeit(lambda: tokens.verify_access_token(token), number=rounds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the old and new access token checks")
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+    results = {"before": before(args.rounds), "after": after(args.rounds)}
+    for name, seconds in results.items():
+        print(f"{name:>6}: {seconds / args.rounds * 1e6:8.2f} us per token ({tokens.ALGORITHM})")
+    print(f"speedup: {results['before'] / results['after']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Compare two benchmark reports
+
+    python benchmarks/compare.py reports/crud-abc1234.json reports/crud-def5678.json
+
+Prints throughput and latency percentiles side by side for every result both
+reports share, with the change relative to the first (the baseline).
+"""
+import argparse
+import json
+
+COLUMNS = ("throughput_per_second", "p50_ms", "p95_ms", "p99_ms")
+
+
+def _change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diff two benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+
+    print(f"{baseline['kind']}: {baseline['commit']} -> {candidate['commit']}")
+    for name in sorted(baseline["results"].keys() & candidate["results"].keys()):
+        before, after = baseline["results"][name], candidate["results"][name]
+        cells = [f"{column} {before[column]:.2f} -> {after[column]:.2f} ({_change(before[column], after[column])})"
+                 for column in COLUMNS if column in before and column in after]
+        print(f"  {name}\n    " + "\n    ".join(cells))
+    for name in sorted(baseline["results"].keys() ^ candidate["results"].keys()):
+        print(f"  {name}: only in {'baseline' if name in baseline['results'] else 'candidate'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Microbenchmarks of the crud functions against a seeded database
+
+    python benchmarks/seed.py
+    python benchmarks/crud_bench.py [--iterations 200] [--only get_books]
+
+Every case runs for the smallest and the largest seeded library, so a change
+that only hurts big shelves shows up as a gap between the two. Each call gets
+its own session, like a request would, and the caches in cache.py are left as
+the app would have them. The write cases add throwaway books (bench-write:...)
+that are removed again when the run ends.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import delete, func  # noqa: E402
+from sqlmodel import Session, select  # noqa: E402
+from sqlmodel.ext.asyncio.session import AsyncSession  # noqa: E402
+
+import crud  # noqa: E402
+import database  # noqa: E402
+import report  # noqa: E402
+from models import Book, Custom_Shelf, End_User, Shelf, Shelf_Book, Shelf_Kind  # noqa: E402
+
+WRITE_BOOK_ID = "bench-write:{}"
+
+
+class Library:
+    """A seeded user and what the cases need to know about their library."""
+
+    def __init__(self, label: str, user: End_User, size: int):
+        self.label = label
+        self.user = user
+        self.size = size
+        self.custom_shelf_name = None
+        self.deep_cursor = None
+
+
+def find_libraries() -> list[Library]:
+    statement = (
+        select(End_User, func.count(Shelf_Book.bookshelf_id).label("size"))
+        .join(Shelf, Shelf.end_user_id == End_User.end_user_id)
+        .join(Shelf_Book, Shelf_Book.shelf_id == Shelf.shelf_id, isouter=True)
+        .where(End_User.email.like("%@bench.local"))
+        .group_by(End_User.end_user_id)
+        .order_by(func.count(Shelf_Book.bookshelf_id), End_User.end_user_id)
+    )
+    with Session(database.engine) as db:
+        rows = db.exec(statement).all()
+        if not rows:
+            raise SystemExit("No benchmark users found, run benchmarks/seed.py first")
+        libraries = [Library("smallest", *rows[0]), Library("largest", *rows[-1])]
+        for library in libraries:
+            library.custom_shelf_name = db.exec(
+                select(Custom_Shelf.shelf_name).where(Custom_Shelf.end_user_id == library.user.end_user_id)
+            ).first()
+    return libraries
+
+
+async def find_deep_cursor(library: Library, pages: int):
+    # The cursor of page N of the read shelf, walked once so the measured call starts there
+    async with AsyncSession(database.async_engine, expire_on_commit=False) as db:
+        cursor = None
+        for _ in range(pages):
+            page = await crud.get_books(db, library.user.end_user_id, Shelf_Kind.READ, 50, cursor)
+            if page.next_cursor is None:
+                break
+            cursor = page.next_cursor
+    library.deep_cursor = cursor
+
+
+def write_book(tag: str) -> Book:
+    return Book(google_book_id=WRITE_BOOK_ID.format(f"{tag}:{uuid.uuid4().hex}"), title="Benchmark book",
+                authors=["Bench Author"], description="Added by crud_bench", number_of_pages=200,
+                categories=["Benchmarks"], published_date="2024")
+
+
+def cases(library: Library) -> dict:
+    """Benchmark name -> coroutine function taking a fresh session."""
+    user = library.user
+    owner_id = user.end_user_id
+
+    async def add_book_to_chosen_shelf(db):
+        shelf = await crud.get_shelf(db, owner_id, Shelf_Kind.TO_READ)
+        await crud.add_book_to_chosen_shelf(db, write_book("single"), shelf)
+
+    async def add_books_to_shelf_batch(db):
+        await crud.add_books_to_shelf_batch(db, owner_id, [write_book("batch") for _ in range(20)], Shelf_Kind.TO_READ)
+
+    benchmarks = {
+        "get_user_by_email": lambda db: crud.get_user_by_email(db, user.email),
+        "get_user": lambda db: crud.get_user(db, owner_id),
+        "get_books_first_page": lambda db: crud.get_books(db, owner_id, Shelf_Kind.READ, 50),
+        "get_books_first_page_by_title": lambda db: crud.get_books(db, owner_id, Shelf_Kind.READ, 50, sort="title"),
+        "get_books_deep_page": lambda db: crud.get_books(db, owner_id, Shelf_Kind.READ, 50, library.deep_cursor),
+        "search_books_text": lambda db: crud.search_books(db, owner_id, q="river"),
+        "search_books_category": lambda db: crud.search_books(db, owner_id, category="Fantasy"),
+        "get_custom_shelves": lambda db: crud.get_custom_shelves(db, owner_id),
+        "get_reading_stats": lambda db: crud.get_reading_stats(db, owner_id),
+        "get_active_goals": lambda db: crud.get_active_goals(db, owner_id),
+        "get_collection_version": lambda db: crud.get_collection_version(db, owner_id, crud.GOALS_COLLECTION),
+        "get_recommendations": lambda db: crud.get_recommendations(db, owner_id),
+        "add_book_to_chosen_shelf": add_book_to_chosen_shelf,
+        "add_books_to_shelf_batch": add_books_to_shelf_batch,
+    }
+    if library.custom_shelf_name:
+        benchmarks["get_custom_books"] = lambda db: crud.get_custom_books(db, owner_id, library.custom_shelf_name)
+    return benchmarks
+
+
+async def measure(call, iterations: int, warmup: int) -> dict:
+    samples = []
+    wall_started = None
+    for index in range(warmup + iterations):
+        if index == warmup:
+            wall_started = time.perf_counter()
+        async with AsyncSession(database.async_engine, expire_on_commit=False) as db:
+            started = time.perf_counter()
+            await call(db)
+            elapsed = time.perf_counter() - started
+        if index >= warmup:
+            samples.append(elapsed)
+    return report.summarize(samples, time.perf_counter() - wall_started)
+
+
+def remove_written_books():
+    written = select(Book.book_id).where(Book.google_book_id.like(WRITE_BOOK_ID.format("%")))
+    with Session(database.engine) as db:
+        db.exec(delete(Shelf_Book).where(Shelf_Book.book_id.in_(written)))
+        db.exec(delete(Book).where(Book.book_id.in_(written)))
+        db.commit()
+
+
+async def run(args) -> dict:
+    libraries = find_libraries()
+    results = {}
+    try:
+        for library in libraries:
+            await find_deep_cursor(library, args.deep_page)
+            print(f"{library.label}: {library.user.email}, {library.size} books")
+            for name, call in cases(library).items():
+                if args.only and name not in args.only:
+                    continue
+                result = results[f"{name}[{library.label}]"] = await measure(call, args.iterations, args.warmup)
+                result["library_size"] = library.size
+                print(f"  {name:<32} p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+                      f"p99 {result['p99_ms']:8.2f} ms  {result['throughput_per_second']:8.1f}/s")
+    finally:
+        remove_written_books()
+        await database.async_engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crud functions")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--deep-page", type=int, default=20, help="Page of the read shelf the deep page case reads")
+    parser.add_argument("--only", nargs="*", help="Benchmark names to run, all of them by default")
+    parser.add_argument("--output", help="Report path, benchmarks/reports/crud-<commit>.json by default")
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    path = report.write_report("crud", results, args.output, iterations=args.iterations, warmup=args.warmup,
+                               deep_page=args.deep_page)
+    print(f"report written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Names shared by the seeder and the load scenario
+
+Kept free of app imports so locust can load it without database settings.
+"""
+import os
+
+BENCH_PASSWORD = os.getenv("BENCH_PASSWORD", "benchmark-password")
+BENCH_EMAIL = "reader{}@bench.local"
+BENCH_BOOK_ID = "bench:{}"
+WORDS = (
+    "night", "river", "glass", "empire", "garden", "winter", "stone", "letters", "silence", "harbor", "crown",
+    "shadow", "orchard", "machine", "ocean", "city", "memory", "fire", "island", "library", "daughter", "storm",
+    "mountain", "secret", "summer", "wolves", "salt", "paper", "lantern", "kingdom", "ghost", "bridge", "song",
+    "desert", "clock", "mirror", "forest", "signal", "tide", "atlas",
+)
+CATEGORIES = (
+    "Fiction", "Fantasy", "Science Fiction", "Mystery", "Thriller", "Romance", "History", "Biography", "Poetry",
+    "Horror", "Young Adult", "Philosophy", "Science", "Travel", "Memoir", "Classics", "Graphic Novels", "Essays",
+)
@@ -0,0 +1,102 @@
+"""HTTP load scenario for a locally running app
+
+    uvicorn main:app --workers 4
+    locust -f benchmarks/locustfile.py --host http://localhost:8000 --headless -u 50 -r 10 -t 2m
+
+Every simulated reader logs in as one of the seeded users (see seed.py) and then
+browses shelves page by page, adds books, checks goals and stats and searches.
+When locust stops, throughput and p50/p95/p99 per endpoint are written to
+benchmarks/reports/http-<commit>.json.
+"""
+import itertools
+import os
+import random
+import sys
+import uuid
+
+from locust import HttpUser, between, events, task
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import report  # noqa: E402
+from dataset import BENCH_EMAIL, BENCH_PASSWORD, WORDS  # noqa: E402
+
+BENCH_USERS = int(os.getenv("BENCH_USERS", "100"))
+SHELF_PATHS = ("/shelves/read", "/shelves/tbr", "/shelves/current", "/shelves/dropped")
+_user_numbers = itertools.count()
+
+
+class Reader(HttpUser):
+    wait_time = between(0.5, 2)
+
+    def on_start(self):
+        email = BENCH_EMAIL.format(next(_user_numbers) % BENCH_USERS)
+        response = self.client.post("/login", data={"username": email, "password": BENCH_PASSWORD})
+        response.raise_for_status()
+        self.client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+    @task(6)
+    def browse_shelf(self):
+        path = random.choice(SHELF_PATHS)
+        cursor = None
+        for _ in range(random.randint(1, 3)):
+            params = {"limit": 50, "cursor": cursor} if cursor else {"limit": 50}
+            page = self.client.get(path, params=params, name=path).json()
+            cursor = page.get("next_cursor")
+            if not cursor:
+                break
+
+    @task(2)
+    def list_custom_shelves(self):
+        self.client.get("/shelves/me", params={"include": "counts,preview"})
+
+    @task(2)
+    def add_book(self):
+        book = {
+            "google_book_id": f"load:{uuid.uuid4().hex}",
+            "title": " ".join(random.sample(WORDS, 3)).title(),
+            "authors": ["Load Author"],
+            "description": "Added by the load test",
+            "number_of_pages": random.randint(80, 900),
+            "categories": ["Benchmarks"],
+            "published_date": "2024",
+        }
+        path = random.choice(("/shelves/tbr", "/shelves/read"))
+        with self.client.post(path, json=book, name=path, catch_response=True) as response:
+            # A book already on the shelf is an expected outcome, not a failure
+            if response.status_code == 409 and "already exists" in response.text:
+                response.success()
+
+    @task(2)
+    def active_goals(self):
+        self.client.get("/goals/active")
+
+    @task(1)
+    def reading_stats(self):
+        self.client.get("/stats/me")
+
+    @task(2)
+    def search(self):
+        self.client.get("/books/search", params={"q": random.choice(WORDS)}, name="/books/search")
+
+
+@events.quitting.add_listener
+def write_http_report(environment, **kwargs):
+    stats = environment.stats
+    results = {}
+    for entry in list(stats.entries.values()) + [stats.total]:
+        if not entry.num_requests:
+            continue
+        name = "total" if entry is stats.total else f"{entry.method} {entry.name}"
+        results[name] = {
+            "count": entry.num_requests,
+            "failures": entry.num_failures,
+            "throughput_per_second": entry.total_rps,
+            "mean_ms": entry.avg_response_time,
+            "p50_ms": entry.get_response_time_percentile(0.50),
+            "p95_ms": entry.get_response_time_percentile(0.95),
+            "p99_ms": entry.get_response_time_percentile(0.99),
+        }
+    path = report.write_report("http", results, os.getenv("BENCH_REPORT"), host=environment.host,
+                               users=environment.runner.user_count if environment.runner else None)
+    print(f"report written to {path}")
@@ -0,0 +1,60 @@
+"""Shared helpers for benchmark reports
+
+Every runner writes one JSON file per run, named after the commit it measured,
+so two runs can be compared with benchmarks/compare.py.
+"""
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+REPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def percentile(sorted_samples: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples: list[float], wall_seconds: float) -> dict:
+    """This function turns call durations (seconds) into the figures every report carries, in milliseconds."""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "throughput_per_second": len(ordered) / wall_seconds if wall_seconds else 0.0,
+        "mean_ms": sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+    }
+
+
+def write_report(kind: str, results: dict, path: str | None = None, **context) -> str:
+    """This function writes a report and returns its path."""
+    commit = git_commit()
+    report = {
+        "kind": kind,
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "context": context,
+        "results": results,
+    }
+    if path is None:
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        path = os.path.join(REPORT_DIR, f"{kind}-{commit}.json")
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    return path
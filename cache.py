@@ -0,0 +1,99 @@
+"""This module contains the in-process caches used by the app"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "1024"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+CATALOGUE_CACHE_MAX_SIZE = int(os.getenv("CATALOGUE_CACHE_MAX_SIZE", "10000"))
+
+
+class CachedBook(NamedTuple):
+    """A compact catalogue record, enough to link a book without reading the book table."""
+    book_id: int
+    title: str
+    authors: tuple
+    number_of_pages: int
+    categories: tuple
+
+
+class CachedUser(NamedTuple):
+    """An authenticated user together with the token version their tokens must carry."""
+    user: object
+    token_version: int
+
+
+class TTLCache:
+    """A bounded LRU cache whose entries expire after ttl seconds (None means never)."""
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Authenticated users keyed by end_user_id
+user_cache = TTLCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
+# Catalogue rows keyed by google_book_id, books are never deleted so entries do not expire
+catalogue_cache = TTLCache(CATALOGUE_CACHE_MAX_SIZE)
+
+
+def remember_book(book) -> CachedBook:
+    """Store a committed book row in the catalogue cache."""
+    cached = CachedBook(book.book_id, book.title, tuple(book.authors or ()), book.number_of_pages,
+                        tuple(book.categories or ()))
+    catalogue_cache.set(book.google_book_id, cached)
+    return cached
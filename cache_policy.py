@@ -0,0 +1,79 @@
+"""This module contains the Cache-Control policies of the routes
+
+Policies are registered against route templates (/journals/{journal_entry_id}/sections,
+not the concrete path) and applied by CacheControlMiddleware when the response
+starts, so 304s from the ETag checks carry them too. A route that sets its own
+Cache-Control keeps it. Error responses are never made cacheable, a 401 or 404
+is sent with no-store whatever the route's policy.
+"""
+from typing import NamedTuple
+
+from starlette.datastructures import MutableHeaders
+
+
+class CachePolicy(NamedTuple):
+    max_age: int = 0
+    stale_while_revalidate: int = 0
+    private: bool = True
+    no_store: bool = False
+    no_cache: bool = False
+
+    def header(self) -> str:
+        if self.no_store:
+            return "no-store"
+        if self.no_cache:
+            return f"{'private' if self.private else 'public'}, no-cache"
+        directives = ["private" if self.private else "public", f"max-age={self.max_age}"]
+        if self.stale_while_revalidate:
+            directives.append(f"stale-while-revalidate={self.stale_while_revalidate}")
+        return ", ".join(directives)
+
+
+NO_STORE = CachePolicy(no_store=True)
+# For responses without an ETag, the client may keep a copy but must ask again before showing it
+NO_CACHE = CachePolicy(no_cache=True)
+
+# (method, route template) -> policy
+_policies: dict[tuple[str, str], CachePolicy] = {}
+
+
+def register(policy: CachePolicy, *paths: str, methods: tuple[str, ...] = ("GET",)):
+    """This function sets the policy of the given route templates."""
+    for path in paths:
+        for method in methods:
+            _policies[(method, path)] = policy
+
+
+def policy_for(method: str, path: str | None) -> CachePolicy | None:
+    return _policies.get((method, path))
+
+
+class CacheControlMiddleware:
+    """Pure ASGI middleware, it only touches the headers of the response start message."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cache_control(message):
+            if message["type"] == "http.response.start":
+                # The router has matched by now, scope["route"] is the route being served
+                route = scope.get("route")
+                policy = policy_for(scope["method"], getattr(route, "path", None))
+                if policy is not None:
+                    message["headers"] = list(message.get("headers", []))
+                    headers = MutableHeaders(raw=message["headers"])
+                    if "cache-control" not in headers:
+                        if message["status"] >= 400:
+                            policy = NO_STORE
+                        headers["Cache-Control"] = policy.header()
+                        # A private response depends on who asked for it
+                        if policy.private and not policy.no_store:
+                            headers.add_vary_header("Authorization")
+            await send(message)
+
+        await self.app(scope, receive, send_with_cache_control)
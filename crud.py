@@ -1,373 +1,971 @@
+import base64
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
 from typing import Any
 from warnings import catch_warnings
 
 from fastapi import HTTPException
 from pydantic import EmailStr
-from sqlalchemy import Row
+from sqlalchemy import Row, delete, exists, func, literal_column, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
-from sqlmodel import Session, select, update
+from sqlalchemy.orm import defer
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 import models
-from models import End_User, EndUserCreate, Custom_Shelf, CustomShelfCreate, To_Read_Shelf, Dropped_Shelf, \
-    Current_Shelf, Read_Shelf, Book, To_Read_Shelf_Book, Dropped_Shelf_Book, Read_Shelf_Book, \
-    Current_Shelf_Book, Custom_Shelf_Book_Link, Reading_Goal
-from security import get_password_hash
+import tokens
+from models import End_User, EndUserCreate, Custom_Shelf, CustomShelfCreate, Shelf, Shelf_Kind, Book, Shelf_Book, \
+    Custom_Shelf_Book_Link, Reading_Goal, Collection_Version
+from cache import CachedBook, catalogue_cache, remember_book, user_cache
+from goals import active_goals_statement, goal_for, progress_counts, progress_update
+from stats import ReadBook, counters_upsert, read_book_counters, stats_from_rows
 
-def get_user_by_email(db: Session, email: str):
+logger = logging.getLogger(__name__)
+
+GOALS_COLLECTION = "goals"
+CUSTOM_SHELVES_COLLECTION = "custom_shelves"
+# A listing row can only refresh the catalogue cache when it carries everything CachedBook holds
+CACHED_BOOK_FIELDS = {"book_id", "google_book_id", "title", "authors", "number_of_pages", "categories"}
+
+
+def shelf_collection(kind: Shelf_Kind) -> str:
+    return f"shelf:{kind.value}"
+
+
+async def get_collection_version(db: AsyncSession, owner_id: int, collection: str) -> int:
+    statement = select(Collection_Version.version).where(
+        Collection_Version.end_user_id == owner_id,
+        Collection_Version.collection == collection
+    )
+    return (await db.exec(statement)).first() or 0
+
+
+def collection_version_upsert(owner_id: int, *collections: str):
+    statement = pg_insert(Collection_Version).values(
+        [{"end_user_id": owner_id, "collection": collection, "version": 1} for collection in collections]
+    )
+    return statement.on_conflict_do_update(
+        index_elements=["end_user_id", "collection"],
+        set_={"version": Collection_Version.version + 1},
+    )
+
+
+async def bump_collection_versions(db: AsyncSession, owner_id: int, *collections: str):
+    # Runs inside the caller's transaction so the version only moves if the write commits
+    await db.execute(collection_version_upsert(owner_id, *collections))
+
+
+async def record_read_books(db: AsyncSession, owner_id: int, books: list[ReadBook], goals: list[Reading_Goal],
+                            *collections: str):
+    # Runs inside the caller's transaction, the counters and goals move together with the Read shelf.
+    # The caller's own collections are bumped in the same upsert as the goals version.
+    if books:
+        await db.execute(counters_upsert(owner_id, read_book_counters(books)))
+        counts = progress_counts(goals, [book.date_read or datetime.now() for book in books])
+        if counts:
+            await db.execute(progress_update(counts))
+            collections += (GOALS_COLLECTION,)
+    if collections:
+        await bump_collection_versions(db, owner_id, *collections)
+
+
+async def get_reading_stats(db: AsyncSession, owner_id: int) -> models.ReadingStats:
+    statement = select(models.Reading_Stat).where(models.Reading_Stat.end_user_id == owner_id)
+    return stats_from_rows((await db.exec(statement)).all())
+
+
+async def get_recommendations(db: AsyncSession, owner_id: int, limit: int = 20) -> list[models.RecommendationRead]:
+    statement = (
+        select(models.Recommendation, Book)
+        .join(Book, Book.book_id == models.Recommendation.book_id)
+        .where(models.Recommendation.end_user_id == owner_id)
+        .order_by(models.Recommendation.rank)
+        .limit(limit)
+    )
+    return [
+        models.RecommendationRead(
+            rank=recommendation.rank, score=recommendation.score, generated_at=recommendation.generated_at, book=book
+        )
+        for recommendation, book in (await db.exec(statement)).all()
+    ]
+
+
+async def get_user_by_email(db: AsyncSession, email: str):
     statement = select(End_User).where(End_User.email == email)
-    return db.exec(statement).first()
+    return (await db.exec(statement)).first()
+
 
+async def get_user(db: AsyncSession, end_user_id: int) -> End_User | None:
+    return await db.get(End_User, end_user_id)
 
-def create_user(db: Session, user_in: EndUserCreate) -> End_User:
+
+async def create_user(db: AsyncSession, user_in: EndUserCreate, password_hash: str) -> End_User:
     user = End_User(
         email=user_in.email,
         username=user_in.username,
-        password_hash=get_password_hash(user_in.password),
+        password_hash=password_hash,
+    )
+    db.add(user)
+    await db.flush()
+    # Every user starts with one shelf of each default kind
+    for kind, shelf_name in models.DEFAULT_SHELF_NAMES.items():
+        db.add(Shelf(end_user_id=user.end_user_id, kind=kind, shelf_name=shelf_name))
+    await db.commit()
+    await db.refresh(user)
+    user_cache.invalidate(user.end_user_id)
+    return user
+
+
+def _add_refresh_token(db: AsyncSession, owner_id: int, family_id: str | None = None) -> str:
+    # Only adds the row, it is written with the caller's commit
+    token, token_hash = tokens.new_refresh_token()
+    db.add(models.Refresh_Token(
+        end_user_id=owner_id,
+        token_hash=token_hash,
+        family_id=family_id or uuid.uuid4().hex,
+        expires_at=datetime.now() + timedelta(days=tokens.REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return token
+
+
+async def create_refresh_token(db: AsyncSession, owner_id: int, family_id: str | None = None) -> str:
+    token = _add_refresh_token(db, owner_id, family_id)
+    await db.commit()
+    return token
+
+
+async def rotate_refresh_token(db: AsyncSession, token: str) -> tuple[End_User, str]:
+    """This function spends a refresh token and returns its user with the token that replaces it."""
+    token_hash = tokens.hash_refresh_token(token)
+    now = datetime.now()
+    # Marking the token used is the claim, of two concurrent refreshes only one gets the row back
+    spent = (await db.execute(
+        update(models.Refresh_Token)
+        .where(
+            models.Refresh_Token.token_hash == token_hash,
+            models.Refresh_Token.used_at.is_(None),
+            models.Refresh_Token.revoked_at.is_(None),
+            models.Refresh_Token.expires_at > now,
+        )
+        .values(used_at=now)
+        .returning(models.Refresh_Token.end_user_id, models.Refresh_Token.family_id)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if not spent:
+        # A token that was already rotated is being replayed, whoever holds the family is no longer trusted
+        statement = select(models.Refresh_Token.family_id).where(
+            models.Refresh_Token.token_hash == token_hash, models.Refresh_Token.used_at.is_not(None)
+        )
+        if family_id := (await db.exec(statement)).first():
+            await _revoke_refresh_family(db, family_id, now)
+        await db.commit()
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    user = await db.get(End_User, spent.end_user_id)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    # The old token is spent and its replacement written in one commit, a failure leaves the old one usable
+    new_token = _add_refresh_token(db, spent.end_user_id, spent.family_id)
+    await db.commit()
+    return user, new_token
+
+
+async def _revoke_refresh_family(db: AsyncSession, family_id: str, now: datetime):
+    await db.execute(
+        update(models.Refresh_Token)
+        .where(models.Refresh_Token.family_id == family_id, models.Refresh_Token.revoked_at.is_(None))
+        .values(revoked_at=now)
+        .execution_options(synchronize_session=False)
     )
+
+
+async def revoke_tokens(db: AsyncSession, owner_id: int, jti: str | None, expires_at: int, refresh_token: str | None):
+    """This function revokes an access token and, when given, the refresh token family it belongs with."""
+    now = datetime.now()
+    if jti:
+        await db.execute(
+            pg_insert(models.Revoked_Token)
+            .values(jti=jti, expires_at=datetime.fromtimestamp(expires_at))
+            .on_conflict_do_nothing()
+        )
+    if refresh_token:
+        statement = select(models.Refresh_Token.family_id).where(
+            models.Refresh_Token.token_hash == tokens.hash_refresh_token(refresh_token),
+            models.Refresh_Token.end_user_id == owner_id,
+        )
+        if family_id := (await db.exec(statement)).first():
+            await _revoke_refresh_family(db, family_id, now)
+    await db.commit()
+    if jti:
+        tokens.revoke_locally(jti)
+
+
+async def get_revoked_token_ids(db: AsyncSession) -> set[str]:
+    # Expired access tokens are rejected anyway, their entries are dropped instead of reloaded
+    now = datetime.now()
+    await db.execute(delete(models.Revoked_Token).where(models.Revoked_Token.expires_at <= now))
+    await db.commit()
+    return set((await db.exec(select(models.Revoked_Token.jti))).all())
+
+
+async def update_password_hash(db: AsyncSession, user: End_User, password_hash: str) -> End_User:
+    user.password_hash = password_hash
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    user_cache.invalidate(user.end_user_id)
     return user
 
 
-def create_custom_shelf(db: Session, owner_id: int, shelf_in: CustomShelfCreate) -> Custom_Shelf:
+async def end_all_sessions(db: AsyncSession, owner_id: int, password_hash: str | None = None) -> End_User:
+    """This function invalidates every access and refresh token of a user, optionally setting a new password."""
+    user = await db.get(End_User, owner_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    # Access tokens carry the version they were issued with, get_current_user rejects the older ones
+    user.token_version += 1
+    if password_hash:
+        user.password_hash = password_hash
+    db.add(user)
+    await db.execute(
+        update(models.Refresh_Token)
+        .where(models.Refresh_Token.end_user_id == owner_id, models.Refresh_Token.revoked_at.is_(None))
+        .values(revoked_at=datetime.now())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    await db.refresh(user)
+    user_cache.invalidate(owner_id)
+    return user
+
+
+async def create_custom_shelf(db: AsyncSession, owner_id: int, shelf_in: CustomShelfCreate) -> Custom_Shelf:
     custom_shelf = Custom_Shelf(end_user_id=owner_id, shelf_name=shelf_in.shelf_name)
-    db.add(custom_shelf)
-    db.commit()
-    db.refresh(custom_shelf)
+    try:
+        db.add(custom_shelf)
+        await bump_collection_versions(db, owner_id, CUSTOM_SHELVES_COLLECTION)
+        await db.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Shelf name already exists for user")
+    await db.refresh(custom_shelf)
     return custom_shelf
 
 
-def get_custom_shelves(db: Session, owner_id: int) -> list[Custom_Shelf]:
+async def get_custom_shelves(db: AsyncSession, owner_id: int) -> list[Custom_Shelf]:
     statement = select(Custom_Shelf).where(Custom_Shelf.end_user_id == owner_id)
-    return db.exec(statement).all()
+    return (await db.exec(statement)).all()
 
 
-def get_tbr_shelf(db: Session, owner_id: int) -> To_Read_Shelf:
-    statement = select(To_Read_Shelf).where(To_Read_Shelf.end_user_id == owner_id)
-    return db.exec(statement).first()
+async def get_custom_shelf_listing(
+        db: AsyncSession,
+        owner_id: int,
+        counts: bool = False,
+        preview_size: int = 0,
+) -> list[models.CustomShelfRead]:
+    # One query whatever the number of shelves: the count is a correlated subquery on the link
+    # primary key, the preview a lateral join that takes the newest preview_size books of each shelf.
+    statement = select(Custom_Shelf).where(Custom_Shelf.end_user_id == owner_id).order_by(Custom_Shelf.shelf_id)
+    if counts:
+        book_count = (
+            select(func.count())
+            .select_from(Custom_Shelf_Book_Link)
+            .where(Custom_Shelf_Book_Link.custom_shelf_id == Custom_Shelf.shelf_id)
+            .scalar_subquery()
+        )
+        statement = statement.add_columns(book_count.label("book_count"))
+    if preview_size:
+        preview = (
+            select(Book.book_id, Book.google_book_id, Book.title, Book.authors, Book.cover_url,
+                   Shelf_Book.bookshelf_id)
+            .join(Shelf_Book, Shelf_Book.book_id == Book.book_id)
+            .join(Custom_Shelf_Book_Link, Custom_Shelf_Book_Link.bookshelf_id == Shelf_Book.bookshelf_id)
+            .where(Custom_Shelf_Book_Link.custom_shelf_id == Custom_Shelf.shelf_id)
+            .order_by(Shelf_Book.bookshelf_id.desc())
+            .limit(preview_size)
+            .lateral("preview")
+        )
+        statement = (
+            statement.add_columns(preview.c.book_id, preview.c.google_book_id, preview.c.title, preview.c.authors,
+                                  preview.c.cover_url)
+            .outerjoin(preview, literal_column("true"))
+            .order_by(preview.c.bookshelf_id.desc())
+        )
 
+    listing = {}
+    for row in (await db.execute(statement)).all():
+        shelf = row[0]
+        entry = listing.get(shelf.shelf_id)
+        if entry is None:
+            entry = listing[shelf.shelf_id] = models.CustomShelfRead(
+                shelf_id=shelf.shelf_id,
+                end_user_id=shelf.end_user_id,
+                shelf_name=shelf.shelf_name,
+                book_count=row.book_count if counts else None,
+                preview=[] if preview_size else None,
+            )
+        if preview_size and row.book_id is not None:
+            entry.preview.append(models.CustomShelfBook(
+                book_id=row.book_id,
+                google_book_id=row.google_book_id,
+                title=row.title,
+                authors=row.authors,
+                cover_url=row.cover_url,
+            ))
+    return list(listing.values())
+
+
+async def get_custom_shelf(db: AsyncSession, owner_id: int, shelf_name: str) -> Custom_Shelf:
+    # A single probe of the unique (end_user_id, shelf_name) index
+    statement = select(Custom_Shelf).where(Custom_Shelf.end_user_id == owner_id, Custom_Shelf.shelf_name == shelf_name)
+    shelf = (await db.exec(statement)).first()
+    if not shelf:
+        raise HTTPException(status_code=404, detail="Shelf not found")
+    return shelf
 
-def get_dropped_shelf(db: Session, owner_id: int) -> Dropped_Shelf:
-    statement = select(Dropped_Shelf).where(Dropped_Shelf.end_user_id == owner_id)
-    return db.exec(statement).first()
 
+async def get_shelf(db: AsyncSession, owner_id: int, kind: Shelf_Kind) -> Shelf:
+    statement = select(Shelf).where(Shelf.end_user_id == owner_id, Shelf.kind == kind)
+    shelf = (await db.exec(statement)).first()
+    if not shelf:
+        raise HTTPException(status_code=404, detail="Shelf not found")
+    return shelf
+
+
+async def get_default_shelves(db: AsyncSession, owner_id: int) -> list[Shelf]:
+    statement = select(Shelf).where(Shelf.end_user_id == owner_id).order_by(Shelf.shelf_id)
+    return (await db.exec(statement)).all()
+
+
+def book_row(book: Book) -> dict:
+    return {
+        "google_book_id": book.google_book_id,
+        "title": book.title,
+        "authors": book.authors,
+        "description": book.description,
+        "number_of_pages": book.number_of_pages,
+        "categories": book.categories,
+        "published_date": book.published_date,
+        "cover_url": book.cover_url,
+    }
+
+
+async def _upsert_books(db: AsyncSession, books: list[Book]) -> dict:
+    """Insert the books the catalogue does not know yet and return google_book_id -> stored catalogue record."""
+    stored = {}
+    missing = {}
+    for book in books:
+        cached = catalogue_cache.get(book.google_book_id)
+        if cached:
+            stored[book.google_book_id] = cached
+        else:
+            missing.setdefault(book.google_book_id, book)
+    if missing:
+        await db.execute(
+            pg_insert(Book).values([book_row(book) for book in missing.values()])
+            .on_conflict_do_nothing(index_elements=["google_book_id"])
+        )
+        # Read back from the table, a book that already existed keeps its stored values whatever the client sent
+        statement = select(*(getattr(Book, field) for field in sorted(CACHED_BOOK_FIELDS))).where(
+            Book.google_book_id.in_(missing.keys())
+        )
+        stored.update((row.google_book_id, row) for row in (await db.exec(statement)).all())
+    return stored
 
-def get_current_shelf(db: Session, owner_id: int) -> Current_Shelf:
-    statement = select(Current_Shelf).where(Current_Shelf.end_user_id == owner_id)
-    return db.exec(statement).first()
 
+def _remember_books(stored: dict):
+    # Only called after commit, a rolled back insert must never reach the cache
+    for record in stored.values():
+        if not isinstance(record, CachedBook):
+            remember_book(record)
 
-def get_read_shelf(db: Session, owner_id: int) -> Read_Shelf:
-    statement = select(Read_Shelf).where(Read_Shelf.end_user_id == owner_id)
-    return db.exec(statement).first()
 
+def _read_book(stored, shelf_book: Shelf_Book) -> ReadBook:
+    # The stored catalogue values, the same ones `python stats.py rebuild` counts
+    return ReadBook(stored.number_of_pages, stored.authors, stored.categories, shelf_book.date_read, shelf_book.rating)
 
-def add_book_to_chosen_shelf(db: Session, book: Book, shelf, shelf_id) -> Book:
-    found_book_statement = select(Book).where(Book.google_book_id == book.google_book_id)
-    print("Book ID: ", book.google_book_id)
-    found_book = db.exec(found_book_statement).first()
 
-    # Add the book to database if not found
-    if not found_book:
-        # does it not read the book properly
-        add_book = models.Book(
-            google_book_id=book.google_book_id,
-            title=book.title,
-            authors=book.authors,
-            description=book.description,
-            number_of_pages=book.number_of_pages,
-            categories=book.categories,
-            published_date=book.published_date,
-        )
-        db.add(add_book)
-        db.commit()
-        db.refresh(add_book)
-        found_book = db.exec(found_book_statement).first()
+async def add_book_to_chosen_shelf(db: AsyncSession, book: Book, shelf) -> Book:
+    stored = await _upsert_books(db, [book])
+    stored_book = stored[book.google_book_id]
+    book_id = stored_book.book_id
 
     match (type(shelf)):
-        case models.To_Read_Shelf:
-            print("This is to be added to the to read shelf")
-            add_book = models.To_Read_Shelf_Book(
-                to_read_shelf_id=shelf_id,
-                book_id=found_book.book_id
+        case models.Shelf:
+            goals = await get_active_goals(db, shelf.end_user_id) if shelf.kind == Shelf_Kind.READ else []
+            date_read = datetime.now() if shelf.kind == Shelf_Kind.READ else None
+            add_book = models.Shelf_Book(
+                shelf_id=shelf.shelf_id,
+                book_id=book_id,
+                date_read=date_read,
+                reading_goal_id=goal_for(goals, date_read) if date_read else None,
             )
             try:
                 db.add(add_book)
-                db.commit()
-                db.refresh(add_book)
-            except IntegrityError as e:
-                raise HTTPException(status_code=500, detail="This book already exists in this shelf")
-        case models.Dropped_Shelf:
-            print("This is to be added to the dropped shelf")
-            add_book = models.Dropped_Shelf_Book(
-                dropped_shelf_id=shelf_id,
-                book_id=found_book.book_id
-            )
-            try:
-                db.add(add_book)
-                db.commit()
-                db.refresh(add_book)
-            except IntegrityError as e:
-                raise HTTPException(status_code=500,
-                                    detail="This book already exists in this shelf")
-            print("This is to be added to the current shelf")
-            add_book = models.Current_Shelf_Book(
-                current_shelf_id=shelf_id,
-                book_id=found_book.book_id
-            )
-            try:
-                db.add(add_book)
-                db.commit()
-                db.refresh(add_book)
-            except IntegrityError as e:
-                raise HTTPException(status_code=500,
-                                    detail="This book already exists in this shelf")
-        case models.Read_Shelf:
-            print("This is to be added to the read shelf")
-            add_book = models.Read_Shelf_Book(
-                read_shelf_id=shelf_id,
-                book_id=found_book.book_id
-            )
-            try:
-                db.add(add_book)
-                db.commit()
-                db.refresh(add_book)
-            except IntegrityError as e:
-                raise HTTPException(status_code=500,
-                                    detail="This book already exists in this shelf")
+                await bump_collection_versions(db, shelf.end_user_id, shelf_collection(shelf.kind))
+                if shelf.kind == Shelf_Kind.READ:
+                    await record_read_books(db, shelf.end_user_id, [_read_book(stored_book, add_book)], goals)
+                await db.commit()
+                await db.refresh(add_book)
+            except IntegrityError:
+                raise HTTPException(status_code=409, detail="This book already exists in this shelf")
         case models.Custom_Shelf:
-            print("This is to be added to the custom shelf")
-            statement = select(Read_Shelf_Book).where(
-                Read_Shelf_Book.book_id == found_book.book_id and
-                Read_Shelf_Book.read_shelf_id == shelf_id
+            logger.debug("Adding book %s to custom shelf %s", book.google_book_id, shelf.shelf_id)
+            read_shelf = await get_shelf(db, shelf.end_user_id, Shelf_Kind.READ)
+            await bump_collection_versions(
+                db, shelf.end_user_id, shelf_collection(Shelf_Kind.READ), CUSTOM_SHELVES_COLLECTION
+            )
+            statement = select(Shelf_Book.bookshelf_id).where(
+                Shelf_Book.book_id == book_id,
+                Shelf_Book.shelf_id == read_shelf.shelf_id
             )
-            book_in_read_shelf = db.exec(statement).first()
+            bookshelf_id = (await db.exec(statement)).first()
 
-            # If it is not in the read book shelve
-            if not book_in_read_shelf:
-                add_book = models.Read_Shelf_Book(
-                    read_shelf_id=shelf_id.shelf_id,
-                    book_id=found_book.book_id
-                )
-                try:
+            try:
+                # If it is not in the read book shelve, it is read now and linked in the same transaction
+                if bookshelf_id is None:
+                    goals = await get_active_goals(db, shelf.end_user_id)
+                    date_read = datetime.now()
+                    add_book = models.Shelf_Book(
+                        shelf_id=read_shelf.shelf_id,
+                        book_id=book_id,
+                        date_read=date_read,
+                        reading_goal_id=goal_for(goals, date_read),
+                    )
                     db.add(add_book)
-                    db.commit()
-                    db.refresh(add_book)
-                    add_to_custom(db, found_book.book_id, shelf_id.shelf_id, shelf_id)
-                except IntegrityError as e:
-                    raise HTTPException(status_code=500,
-                                        detail="This book already exists in this shelf")
-            else:
-                try:
-                    add_to_custom(db, found_book.book_id, shelf_id.shelf_id, shelf_id)
-                except IntegrityError as e:
-                    raise HTTPException(status_code=500,
-                                        detail="This book already exists in this shelf")
+                    await db.flush()
+                    bookshelf_id = add_book.bookshelf_id
+                    await record_read_books(db, shelf.end_user_id, [_read_book(stored_book, add_book)], goals)
+                added = await add_to_custom(db, bookshelf_id, shelf.shelf_id)
+            except IntegrityError:
+                added = False
+            if not added:
+                # Nothing is committed, the session rolls the version bump back when it closes
+                raise HTTPException(status_code=409, detail="This book already exists in this shelf")
+            await db.commit()
         case _:
             raise HTTPException(status_code=400, detail="Unknown shelf type")
 
+    _remember_books(stored)
     return book
 
 
-def add_to_custom(db, book_id, read_shelf_id, custom_shelf):
-    print("Adding to custom shelf")
-    read_shelf_book_statement = select(Read_Shelf_Book).where(
-        Read_Shelf_Book.book_id == book_id and
-        Read_Shelf_Book.read_shelf_id == read_shelf_id
+async def add_to_custom(db: AsyncSession, bookshelf_id: int, custom_shelf_id: int) -> bool:
+    # The link row is inserted directly, loading shelf_books to append to it would read the whole shelf.
+    # Returns False when the book was already on the custom shelf.
+    statement = (
+        pg_insert(Custom_Shelf_Book_Link)
+        .values(custom_shelf_id=custom_shelf_id, bookshelf_id=bookshelf_id)
+        .on_conflict_do_nothing()
+        .returning(Custom_Shelf_Book_Link.bookshelf_id)
     )
-    print("READ SHELF STMT: ", read_shelf_book_statement)
-
-    custom_shelf_statement = select(Custom_Shelf).where(
-        Custom_Shelf.shelf_id == custom_shelf.shelf_id and
-        Custom_Shelf.shelf_name == custom_shelf.shelf_name
+    return (await db.execute(statement)).first() is not None
+
+
+def _book_items(rows: list, fields: tuple[str, ...]) -> list[models.BookListItem]:
+    """Listing rows start with the projected book columns, in fields order, whatever follows is for the cursor."""
+    cacheable = CACHED_BOOK_FIELDS.issubset(fields)
+    items = []
+    for row in rows:
+        item = models.BookListItem(**dict(zip(fields, row)))
+        if cacheable:
+            remember_book(item)
+        items.append(item)
+    return items
+
+
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def _cursor_value(value, expected: type):
+    # bool is an int to isinstance, a cursor never holds one
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if expected is datetime and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if expected is float and isinstance(value, (int, float)):
+        return float(value)
+    if expected in (int, str) and isinstance(value, expected):
+        return value
+    raise ValueError(value)
+
+
+def _decode_cursor(cursor: str, *types: type) -> list:
+    """This function decodes a cursor into one value per type, anything else a client sends is a 400."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(values)
+        return [_cursor_value(value, expected) for value, expected in zip(values, types)]
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def get_books(
+        db: AsyncSession,
+        owner_id: int,
+        kind: Shelf_Kind,
+        limit: int = 50,
+        cursor: str | None = None,
+        sort: str = "added",
+        fields: tuple[str, ...] = models.BOOK_SUMMARY_FIELDS,
+) -> models.BookPage:
+    # One query: the shelf is resolved through the join, books come back in shelf order.
+    # bookshelf_id grows with every insert, so it doubles as the "date added" order and
+    # as the tie breaker that keeps the keyset stable. Only the projected columns are read,
+    # plus the title for the cursor.
+    statement = (
+        select(*(getattr(Book, field) for field in fields), Shelf_Book.bookshelf_id, Book.title.label("sort_title"))
+        .join(Shelf_Book, Shelf_Book.book_id == Book.book_id)
+        .join(Shelf, Shelf.shelf_id == Shelf_Book.shelf_id)
+        .where(Shelf.end_user_id == owner_id, Shelf.kind == kind)
     )
 
-    print("CUSTOM SHELF STMT: ", custom_shelf_statement)
-    custom_shelf = db.exec(custom_shelf_statement).first()
-    read_shelf_book = db.exec(read_shelf_book_statement).first()
-    print("Custom Shelf (Shelf books) is: ", custom_shelf.shelf_books)
-    custom_shelf.shelf_books.append(read_shelf_book)
-    db.add(custom_shelf)
-    db.commit()
-    db.refresh(custom_shelf)
-
-
-def get_books(
-        db: Session,
+    match sort:
+        case "added":
+            if cursor:
+                (last_id,) = _decode_cursor(cursor, int)
+                statement = statement.where(Shelf_Book.bookshelf_id > last_id)
+            statement = statement.order_by(Shelf_Book.bookshelf_id)
+        case "title":
+            if cursor:
+                last_title, last_id = _decode_cursor(cursor, str, int)
+                statement = statement.where(
+                    tuple_(Book.title, Shelf_Book.bookshelf_id) > tuple_(last_title, last_id)
+                )
+            statement = statement.order_by(Book.title, Shelf_Book.bookshelf_id)
+        case _:
+            raise HTTPException(status_code=400, detail="Unknown sort order")
+
+    rows = (await db.exec(statement.limit(limit + 1))).all()
+    books = _book_items(rows[:limit], fields)
+
+    next_cursor = None
+    if len(rows) > limit:
+        *_, last_id, last_title = rows[limit - 1]
+        next_cursor = _encode_cursor([last_id] if sort == "added" else [last_title, last_id])
+    return models.BookPage(items=books, next_cursor=next_cursor)
+
+
+async def add_books_to_shelf_batch(db: AsyncSession, owner_id: int, books: list[Book], kind: Shelf_Kind) -> list[models.BookBatchResult]:
+    shelf = await get_shelf(db, owner_id, kind)
+    if not books:
+        return []
+
+    unique_books = {}
+    for book in books:
+        unique_books.setdefault(book.google_book_id, book)
+
+    # Upsert the catalogue rows in one statement, books we already know are left untouched
+    stored = await _upsert_books(db, list(unique_books.values()))
+    book_ids = {google_book_id: record.book_id for google_book_id, record in stored.items()}
+
+    date_read = datetime.now() if kind == Shelf_Kind.READ else None
+    goals = await get_active_goals(db, owner_id) if kind == Shelf_Kind.READ else []
+    reading_goal_id = goal_for(goals, date_read) if date_read else None
+    link_rows = [
+        {
+            "shelf_id": shelf.shelf_id,
+            "book_id": book_id,
+            "date_added": datetime.now(),
+            "date_read": date_read,
+            "reading_goal_id": reading_goal_id,
+        }
+        for book_id in book_ids.values()
+    ]
+    added_ids = set((await db.execute(
+        pg_insert(Shelf_Book).values(link_rows).on_conflict_do_nothing().returning(Shelf_Book.book_id)
+    )).scalars())
+    if added_ids:
+        read_books = [
+            ReadBook(record.number_of_pages, record.authors, record.categories, date_read, None)
+            for record in stored.values() if record.book_id in added_ids
+        ] if kind == Shelf_Kind.READ else []
+        await record_read_books(db, owner_id, read_books, goals, shelf_collection(kind))
+    await db.commit()
+    _remember_books(stored)
+
+    results = []
+    for book in books:
+        book_id = book_ids[book.google_book_id]
+        status = "added" if book_id in added_ids else "already_present"
+        # A book listed twice in one batch is only added once
+        added_ids.discard(book_id)
+        results.append(models.BookBatchResult(google_book_id=book.google_book_id, book_id=book_id, status=status))
+    return results
+
+
+async def search_books(
+        db: AsyncSession,
         owner_id: int,
-        shelf
-):
-    print("I am getting the books")
-    match (type(shelf)):
-        case models.To_Read_Shelf:
-            statement = select(To_Read_Shelf.shelf_id).where(
-                To_Read_Shelf.end_user_id == owner_id)
-            shelf_id = db.exec(statement).first()
-
-            second_statement = select(To_Read_Shelf_Book.book_id).where(
-                To_Read_Shelf_Book.to_read_shelf_id == shelf_id
-            )
-            all_book_ids = db.exec(second_statement).all()
-            books = []
-
-            for book_id in all_book_ids:
-                statement = select(Book).where(Book.book_id == book_id)
-                books.append(db.exec(statement).first())
-            return books
-        case models.Dropped_Shelf:
-            statement = select(Dropped_Shelf.shelf_id).where(
-                Dropped_Shelf.end_user_id == owner_id)
-            shelf_id = db.exec(statement).first()
-
-            second_statement = select(Dropped_Shelf_Book.book_id).where(
-                Dropped_Shelf_Book.dropped_shelf_id == shelf_id
-            )
-            all_book_ids = db.exec(second_statement).all()
-            books = []
-
-            for book_id in all_book_ids:
-                statement = select(Book).where(Book.book_id == book_id)
-                books.append(db.exec(statement).first())
-            return books
-        case models.Current_Shelf:
-            statement = select(Current_Shelf.shelf_id).where(
-                Current_Shelf.end_user_id == owner_id)
-            shelf_id = db.exec(statement).first()
-
-            second_statement = select(Current_Shelf_Book.book_id).where(
-                Current_Shelf_Book.current_shelf_id == shelf_id
-            )
-            all_book_ids = db.exec(second_statement).all()
-            books = []
-
-            for book_id in all_book_ids:
-                statement = select(Book).where(Book.book_id == book_id)
-                books.append(db.exec(statement).first())
-            return books
-        case models.Read_Shelf:
-            statement = select(Read_Shelf.shelf_id).where(
-                Read_Shelf.end_user_id == owner_id)
-            shelf_id = db.exec(statement).first()
-
-            second_statement = select(Read_Shelf_Book.book_id).where(
-                Read_Shelf_Book.read_shelf_id == shelf_id
-            )
-            all_book_ids = db.exec(second_statement).all()
-            books = []
+        q: str | None = None,
+        author: str | None = None,
+        category: str | None = None,
+        kind: Shelf_Kind | None = None,
+        limit: int = 20,
+        cursor: str | None = None,
+        fields: tuple[str, ...] = models.BOOK_SUMMARY_FIELDS,
+) -> models.BookPage:
+    on_users_shelf = (
+        select(Shelf_Book.bookshelf_id)
+        .join(Shelf, Shelf.shelf_id == Shelf_Book.shelf_id)
+        .where(Shelf_Book.book_id == Book.book_id, Shelf.end_user_id == owner_id)
+    )
+    if kind:
+        on_users_shelf = on_users_shelf.where(Shelf.kind == kind)
+
+    if q:
+        query = func.websearch_to_tsquery(literal_column("'english'::regconfig"), q)
+        document = literal_column(models.BOOK_SEARCH_DOCUMENT)
+        rank = func.ts_rank(document, query)
+        statement = select(*(getattr(Book, field) for field in fields), Book.book_id.label("cursor_id"), rank)
+        statement = statement.where(document.op("@@")(query))
+    else:
+        rank = literal_column("0.0")
+        statement = select(*(getattr(Book, field) for field in fields), Book.book_id.label("cursor_id"), rank)
+    statement = statement.where(exists(on_users_shelf))
+    # @> on the array columns is served by their GIN indexes
+    if author:
+        statement = statement.where(Book.authors.contains([author]))
+    if category:
+        statement = statement.where(Book.categories.contains([category]))
+
+    # Best matches first, book_id breaks ties so the keyset is stable
+    if cursor:
+        last_rank, last_id = _decode_cursor(cursor, float, int)
+        statement = statement.where(
+            (rank < last_rank) | ((rank == last_rank) & (Book.book_id > last_id))
+        )
+    statement = statement.order_by(rank.desc(), Book.book_id).limit(limit + 1)
 
-            for book_id in all_book_ids:
-                statement = select(Book).where(Book.book_id == book_id)
-                books.append(db.exec(statement).first())
-            return books
-        case _:
-            raise HTTPException(status_code=400, detail="Unknown shelf type")
+    rows = (await db.exec(statement)).all()
+    books = _book_items(rows[:limit], fields)
+    next_cursor = None
+    if len(rows) > limit:
+        *_, last_id, last_rank = rows[limit - 1]
+        next_cursor = _encode_cursor([float(last_rank), last_id])
+    return models.BookPage(items=books, next_cursor=next_cursor)
 
 
-def get_custom_books(
-        db: Session,
+async def get_custom_books(
+        db: AsyncSession,
         owner_id: int,
-        shelf_name
-):
-    # Find the custom shelf by name and owner
-    custom_shelf_statement = select(Custom_Shelf).where(
-        Custom_Shelf.end_user_id == owner_id,
-        Custom_Shelf.shelf_name == shelf_name
+        shelf_name,
+        fields: tuple[str, ...] = models.BOOK_SUMMARY_FIELDS,
+) -> list[models.BookListItem]:
+    # One query: the outer joins keep the shelf row when it holds no books, so an empty shelf is not a 404
+    statement = (
+        select(*(getattr(Book, field) for field in fields), Shelf_Book.bookshelf_id, Custom_Shelf.shelf_id)
+        .select_from(Custom_Shelf)
+        .outerjoin(Custom_Shelf_Book_Link, Custom_Shelf_Book_Link.custom_shelf_id == Custom_Shelf.shelf_id)
+        .outerjoin(Shelf_Book, Shelf_Book.bookshelf_id == Custom_Shelf_Book_Link.bookshelf_id)
+        .outerjoin(Book, Book.book_id == Shelf_Book.book_id)
+        .where(Custom_Shelf.end_user_id == owner_id, Custom_Shelf.shelf_name == shelf_name)
+        .order_by(Shelf_Book.bookshelf_id)
     )
-    custom_shelf = db.exec(custom_shelf_statement).first()
-
-    if not custom_shelf:
+    rows = (await db.exec(statement)).all()
+    if not rows:
         raise HTTPException(status_code=404, detail="Custom shelf not found")
 
-    # Get the read shelf books associated with this custom shelf
-    read_shelf_books = custom_shelf.shelf_books
-
-    # Get the actual book objects
-    books = []
-    for book in read_shelf_books:
-        statement = select(Book).where(
-            Book.book_id == book.book_id
-        )
-        book_to_add = db.exec(statement).first()
-        if book:
-            books.append(book_to_add)
-    return books
+    return _book_items([row for row in rows if row.bookshelf_id is not None], fields)
 
 
 # PROMPT: can you make the crud functions for reading goals so i can create, read, update, and delete them for a specific user using sqlmodel?
-def create_reading_goal(db: Session, user_id: int, goal_in: models.ReadingGoalCreate):
+def _read_in_window(owner_id: int, goal: Reading_Goal):
+    finished = func.coalesce(Shelf_Book.date_read, Shelf_Book.date_added)
+    conditions = [
+        Shelf_Book.shelf_id == select(Shelf.shelf_id).where(
+            Shelf.end_user_id == owner_id, Shelf.kind == Shelf_Kind.READ
+        ).scalar_subquery(),
+        finished >= goal.start_date,
+    ]
+    if goal.end_date:
+        conditions.append(finished <= goal.end_date)
+    return conditions
+
+
+async def create_reading_goal(db: AsyncSession, user_id: int, goal_in: models.ReadingGoalCreate):
     goal = models.Reading_Goal(
         end_user_id=user_id,
         title=goal_in.title,
-        progress=goal_in.progress or 0,
         target=goal_in.target,
-        active=goal_in.active if hasattr(goal_in, "active") else True
+        active=goal_in.active if goal_in.active is not None else True,
+        start_date=goal_in.start_date or datetime.now(),
+        end_date=goal_in.end_date,
     )
 
     db.add(goal)
-    db.commit()
-    db.refresh(goal)
+    if goal_in.start_date:
+        # A window opening in the past starts with the books already read inside it
+        await db.flush()
+        conditions = _read_in_window(user_id, goal)
+        goal.progress = (await db.exec(select(func.count()).select_from(Shelf_Book).where(*conditions))).one()
+        goal.active = goal.active and goal.progress < goal.target
+        await db.execute(
+            update(Shelf_Book).where(Shelf_Book.reading_goal_id.is_(None), *conditions)
+            .values(reading_goal_id=goal.reading_goal_id)
+            .execution_options(synchronize_session=False)
+        )
+    await bump_collection_versions(db, user_id, GOALS_COLLECTION)
+    await db.commit()
+    await db.refresh(goal)
     return goal
 
 
-def get_reading_goals(db: Session, user_id: int):
-    return db.query(models.Reading_Goal).filter(models.Reading_Goal.end_user_id == user_id).all()
+async def get_reading_goals(db: AsyncSession, user_id: int):
+    statement = select(models.Reading_Goal).where(models.Reading_Goal.end_user_id == user_id)
+    return (await db.exec(statement)).all()
 
 
-def get_active_goals(db: Session, user_id: int):
-    return db.query(models.Reading_Goal).filter(
-        models.Reading_Goal.end_user_id == user_id,
-        models.Reading_Goal.active == True
-    ).all()
+async def get_active_goals(db: AsyncSession, user_id: int):
+    return (await db.exec(active_goals_statement(user_id))).all()
 
 
-def get_completed_goals(db: Session, user_id: int):
-    return db.query(models.Reading_Goal).filter(
+async def get_completed_goals(db: AsyncSession, user_id: int):
+    statement = select(models.Reading_Goal).where(
         models.Reading_Goal.end_user_id == user_id,
         models.Reading_Goal.active == False
-    ).all()
+    )
+    return (await db.exec(statement)).all()
+
+
+async def create_import_job(db: AsyncSession, owner_id: int, source: str, file_path: str) -> models.Import_Job:
+    history = models.Transfer_History()
+    db.add(history)
+    await db.flush()
+    job = models.Import_Job(
+        end_user_id=owner_id,
+        transfer_history_id=history.transfer_history_id,
+        source=source,
+        file_path=file_path,
+    )
+    db.add(job)
+    await db.execute(
+        update(End_User).where(End_User.end_user_id == owner_id)
+        .values(transfer_history_id=history.transfer_history_id)
+    )
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+async def get_import_job(db: AsyncSession, owner_id: int, job_id: int) -> models.Import_Job:
+    job = await db.get(models.Import_Job, job_id)
+    if not job or job.end_user_id != owner_id:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return job
+
+
+async def claim_import_job(db: AsyncSession, owner_id: int, job_id: int, stale_before: datetime) -> models.Import_Job:
+    # Only one caller can move a job back to running: failed jobs, or running ones whose worker stopped reporting
+    statement = (
+        update(models.Import_Job)
+        .where(
+            models.Import_Job.import_job_id == job_id,
+            models.Import_Job.end_user_id == owner_id,
+            (models.Import_Job.status == models.Import_Status.FAILED) |
+            ((models.Import_Job.status.in_([models.Import_Status.PENDING, models.Import_Status.RUNNING])) &
+             (models.Import_Job.updated_at < stale_before))
+        )
+        .values(status=models.Import_Status.PENDING, error=None, updated_at=datetime.now())
+        .returning(models.Import_Job.import_job_id)
+    )
+    claimed = (await db.execute(statement)).first()
+    await db.commit()
+    if not claimed:
+        raise HTTPException(status_code=409, detail="This import is not waiting to be resumed")
+    return await get_import_job(db, owner_id, job_id)
 
 
-def update_reading_goal(db: Session, user_id: int, goal_id: int, goal_in: models.ReadingGoalUpdate):
-    goal = db.get(models.Reading_Goal, goal_id)
+async def update_reading_goal(db: AsyncSession, user_id: int, goal_id: int, goal_in: models.ReadingGoalUpdate):
+    goal = await db.get(models.Reading_Goal, goal_id)
     if not goal:
         raise HTTPException(status_code=404, detail="Reading goal not found")
     if goal.end_user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized to update this goal")
     for key, value in goal_in.dict(exclude_unset=True).items():
         setattr(goal, key, value)
+    if goal.progress >= goal.target:
+        goal.active = False
     db.add(goal)
-    db.commit()
-    db.refresh(goal)
+    await bump_collection_versions(db, user_id, GOALS_COLLECTION)
+    await db.commit()
+    await db.refresh(goal)
     return goal
 
 
-def delete_reading_goal(db: Session, user_id: int, goal_id: int):
-    goal = db.get(models.Reading_Goal, goal_id)
+async def delete_reading_goal(db: AsyncSession, user_id: int, goal_id: int):
+    goal = await db.get(models.Reading_Goal, goal_id)
     if not goal:
         raise HTTPException(status_code=404, detail="Reading goal not found")
     if goal.end_user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this goal")
-    db.delete(goal)
-    db.commit()
+    await db.execute(
+        update(Shelf_Book).where(Shelf_Book.reading_goal_id == goal_id).values(reading_goal_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    await db.delete(goal)
+    await bump_collection_versions(db, user_id, GOALS_COLLECTION)
+    await db.commit()
     return {"message": "Goal deleted"}
 
 
-def update_custom_shelf_name(db: Session, user_id: int, shelf_name: str, new_shelf_name: str):
-    statement = select(Custom_Shelf).where(
-        Custom_Shelf.end_user_id == user_id and
-        Custom_Shelf.shelf_name == shelf_name
+async def update_custom_shelf_name(db: AsyncSession, user_id: int, shelf_name: str, new_shelf_name: str):
+    statement = (
+        update(Custom_Shelf)
+        .where(Custom_Shelf.end_user_id == user_id, Custom_Shelf.shelf_name == shelf_name)
+        .values(shelf_name=new_shelf_name)
+        .returning(Custom_Shelf.shelf_id)
     )
-    shelf = db.exec(statement).first()
-    if not shelf:
-        raise HTTPException(status_code=404, detail="Shelf not found")
-
-    shelf.shelf_name = new_shelf_name
-    print("SHELF NEW NAME IS :", new_shelf_name)
-    try :
-        db.add(shelf)
-        db.commit()
-        db.refresh(shelf)
+    try:
+        shelf_id = (await db.execute(statement)).scalar_one_or_none()
+        if shelf_id is None:
+            raise HTTPException(status_code=404, detail="Shelf not found")
+        logger.debug("Renaming custom shelf %s to %s", shelf_id, new_shelf_name)
+        await bump_collection_versions(db, user_id, CUSTOM_SHELVES_COLLECTION)
+        await db.commit()
     except IntegrityError:
         raise HTTPException(status_code=409, detail="Shelf name already exists for user")
-    return new_shelf_name
\ No newline at end of file
+    return new_shelf_name
+
+
+async def create_journal_entry(db: AsyncSession, owner_id: int, entry_in: models.JournalEntryCreate) -> models.Journal_Entry:
+    # One journal per book, asking again returns the existing one
+    statement = pg_insert(models.Journal_Entry).values(end_user_id=owner_id, book_id=entry_in.book_id)
+    try:
+        await db.execute(statement.on_conflict_do_nothing(index_elements=["end_user_id", "book_id"]))
+        await db.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Book not found")
+    statement = select(models.Journal_Entry).where(
+        models.Journal_Entry.end_user_id == owner_id,
+        models.Journal_Entry.book_id == entry_in.book_id
+    )
+    return (await db.exec(statement)).first()
+
+
+async def get_journal_entries(db: AsyncSession, owner_id: int) -> list[models.Journal_Entry]:
+    statement = select(models.Journal_Entry).where(models.Journal_Entry.end_user_id == owner_id)
+    return (await db.exec(statement)).all()
+
+
+def _owned_journal(owner_id: int, journal_entry_id: int):
+    return select(models.Journal_Entry.journal_entry_id).where(
+        models.Journal_Entry.journal_entry_id == journal_entry_id,
+        models.Journal_Entry.end_user_id == owner_id
+    )
+
+
+def _section_summary(section: models.Log_Section, text_length: int) -> models.LogSectionSummary:
+    return models.LogSectionSummary(
+        log_section_id=section.log_section_id,
+        journal_entry_id=section.journal_entry_id,
+        section_name=section.section_name,
+        original_date=section.original_date,
+        edited_date=section.edited_date,
+        text_length=text_length,
+    )
+
+
+async def add_log_section(
+        db: AsyncSession,
+        owner_id: int,
+        journal_entry_id: int,
+        section_in: models.LogSectionCreate
+) -> models.LogSectionSummary:
+    if not (await db.exec(_owned_journal(owner_id, journal_entry_id))).first():
+        raise HTTPException(status_code=404, detail="Journal entry not found")
+    section = models.Log_Section(
+        journal_entry_id=journal_entry_id,
+        section_name=section_in.section_name,
+        entry_text=section_in.entry_text,
+    )
+    db.add(section)
+    await db.commit()
+    return _section_summary(section, len(section_in.entry_text))
+
+
+async def get_log_sections(
+        db: AsyncSession,
+        owner_id: int,
+        journal_entry_id: int,
+        limit: int = 20,
+        cursor: str | None = None,
+) -> models.LogSectionPage:
+    # entry_text stays in the database, the listing only carries its length
+    statement = (
+        select(models.Log_Section, func.char_length(models.Log_Section.entry_text))
+        .options(defer(models.Log_Section.entry_text))
+        .where(models.Log_Section.journal_entry_id.in_(_owned_journal(owner_id, journal_entry_id)))
+    )
+    if cursor:
+        last_date, last_id = _decode_cursor(cursor, datetime, int)
+        statement = statement.where(
+            tuple_(models.Log_Section.original_date, models.Log_Section.log_section_id)
+            > tuple_(last_date, last_id)
+        )
+    statement = statement.order_by(models.Log_Section.original_date, models.Log_Section.log_section_id)
+
+    rows = (await db.exec(statement.limit(limit + 1))).all()
+    items = [_section_summary(section, text_length) for section, text_length in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = _encode_cursor([last.original_date.isoformat(), last.log_section_id])
+    return models.LogSectionPage(items=items, next_cursor=next_cursor)
+
+
+async def get_log_section(db: AsyncSession, owner_id: int, journal_entry_id: int, log_section_id: int) -> models.LogSectionRead:
+    statement = select(models.Log_Section).where(
+        models.Log_Section.log_section_id == log_section_id,
+        models.Log_Section.journal_entry_id.in_(_owned_journal(owner_id, journal_entry_id))
+    )
+    section = (await db.exec(statement)).first()
+    if not section:
+        raise HTTPException(status_code=404, detail="Log section not found")
+    return models.LogSectionRead(**_section_summary(section, len(section.entry_text)).model_dump(),
+                                 entry_text=section.entry_text)
+
+
+async def update_log_section(
+        db: AsyncSession,
+        owner_id: int,
+        journal_entry_id: int,
+        log_section_id: int,
+        section_in: models.LogSectionUpdate
+) -> models.LogSectionSummary:
+    if section_in.entry_text is not None and section_in.append_text is not None:
+        raise HTTPException(status_code=400, detail="Send either entry_text or append_text, not both")
+    values = {"edited_date": datetime.now()}
+    if section_in.section_name is not None:
+        values["section_name"] = section_in.section_name
+    if section_in.entry_text is not None:
+        values["entry_text"] = section_in.entry_text
+    if section_in.append_text is not None:
+        # Appending happens in SQL, the stored text never travels to the app and back
+        values["entry_text"] = models.Log_Section.entry_text + section_in.append_text
+
+    statement = (
+        update(models.Log_Section)
+        .where(
+            models.Log_Section.log_section_id == log_section_id,
+            models.Log_Section.journal_entry_id.in_(_owned_journal(owner_id, journal_entry_id))
+        )
+        .values(**values)
+        .returning(
+            models.Log_Section.log_section_id,
+            models.Log_Section.journal_entry_id,
+            models.Log_Section.section_name,
+            models.Log_Section.original_date,
+            models.Log_Section.edited_date,
+            func.char_length(models.Log_Section.entry_text).label("text_length"),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    row = (await db.execute(statement)).first()
+    await db.commit()
+    if not row:
+        raise HTTPException(status_code=404, detail="Log section not found")
+    return models.LogSectionSummary(**row._mapping)
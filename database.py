@@ -1,12 +1,64 @@
 """This module contains database configuration"""
 import os
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _env_flag(name: str, default: bool) -> bool:
+    """This function reads a true/false environment variable"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL, echo=True)
+# Request handlers use psycopg 3 in async mode, startup and background jobs keep the sync engine
+ASYNC_DATABASE_URL = make_url(DATABASE_URL).set(drivername="postgresql+psycopg")
+
+DB_ECHO = _env_flag("DB_ECHO", False)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = _env_flag("DB_POOL_PRE_PING", True)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Set when connections go through PgBouncer (or another pooler) in transaction mode
+DB_EXTERNAL_POOLER = _env_flag("DB_EXTERNAL_POOLER", False)
+
+
+def _engine_options(async_driver: bool) -> dict:
+    """This function builds the engine keyword arguments from the environment"""
+    connect_args = {}
+    options = {"echo": DB_ECHO, "connect_args": connect_args}
+    if DB_EXTERNAL_POOLER:
+        # The pooler owns the connections, and server side prepared statements do not
+        # survive being moved between backends. Poolers reject the "options" startup
+        # parameter, so the statement timeout has to be set on the database role instead.
+        options["poolclass"] = NullPool
+        if async_driver:
+            connect_args["prepare_threshold"] = None
+    else:
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+        if DB_STATEMENT_TIMEOUT_MS:
+            connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    return options
+
+
+engine = create_engine(DATABASE_URL, **_engine_options(async_driver=False))
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options(async_driver=True))
 
 def init_db():
     """This function initializes the database"""
@@ -17,3 +69,27 @@ def get_session():
     """This function is used to create a sqlmodel session"""
     with Session(engine) as session:
         yield session
+
+
+async def get_async_session():
+    """This function is used to create an async sqlmodel session for request handlers"""
+    # Objects stay usable after commit, lazy refreshes are not possible on an async session
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+def pool_status() -> dict:
+    """This function reports how busy the connection pools are"""
+    status = {}
+    for name, pool in (("async", async_engine.pool), ("sync", engine.pool)):
+        if isinstance(pool, NullPool):
+            status[name] = {"pool": "external"}
+            continue
+        status[name] = {
+            "pool": "internal",
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+    return status
@@ -0,0 +1,23 @@
+"""This module contains the conditional GET helpers for listing routes"""
+import hashlib
+
+from fastapi import Request
+
+
+def collection_etag(request: Request, owner_id: int, collection: str, version: int) -> str:
+    """This function builds a weak ETag from a collection version and the page being asked for."""
+    # Different paths (/shelves/me, each custom shelf) and query strings (cursor, limit, sort) are
+    # different representations of the same version
+    key = f"{owner_id}:{collection}:{version}:{request.url.path}?{request.url.query}"
+    return f'W/"{hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """This function checks If-None-Match using the weak comparison from RFC 9110."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in header.split(","))
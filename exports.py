@@ -0,0 +1,142 @@
+"""This module contains the streaming library export
+
+Rows are read through a server-side cursor (yield_per) and encoded one at a time,
+so an export of any size runs in flat memory and the first bytes leave right away.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from sqlmodel import Session, select
+
+import database
+from models import Book, Custom_Shelf, Custom_Shelf_Book_Link, Journal_Entry, Log_Section, Shelf, Shelf_Book
+
+YIELD_PER = 1000
+CSV_COLUMNS = [
+    "type", "shelf", "google_book_id", "title", "authors", "number_of_pages", "categories", "published_date",
+    "date_added", "date_read", "rating", "section_name", "entry_text", "original_date", "edited_date",
+]
+
+
+def _stream(db: Session, statement):
+    return db.exec(statement.execution_options(stream_results=True, yield_per=YIELD_PER))
+
+
+def library_records(owner_id: int) -> Iterator[dict]:
+    """This function yields every shelf entry, custom shelf entry and journal section of a user."""
+    with Session(database.engine) as db:
+        shelf_books = (
+            select(Shelf.kind, Shelf_Book.date_added, Shelf_Book.date_read, Shelf_Book.rating, Book.google_book_id,
+                   Book.title, Book.authors, Book.number_of_pages, Book.categories, Book.published_date)
+            .join(Shelf, Shelf.shelf_id == Shelf_Book.shelf_id)
+            .join(Book, Book.book_id == Shelf_Book.book_id)
+            .where(Shelf.end_user_id == owner_id)
+            .order_by(Shelf_Book.bookshelf_id)
+        )
+        for row in _stream(db, shelf_books):
+            yield {
+                "type": "shelf_book",
+                "shelf": row.kind.value,
+                "google_book_id": row.google_book_id,
+                "title": row.title,
+                "authors": row.authors,
+                "number_of_pages": row.number_of_pages,
+                "categories": row.categories,
+                "published_date": row.published_date,
+                "date_added": row.date_added,
+                "date_read": row.date_read,
+                "rating": row.rating,
+            }
+
+        custom_books = (
+            select(Custom_Shelf.shelf_name, Book.google_book_id, Book.title)
+            .join(Custom_Shelf_Book_Link, Custom_Shelf_Book_Link.custom_shelf_id == Custom_Shelf.shelf_id)
+            .join(Shelf_Book, Shelf_Book.bookshelf_id == Custom_Shelf_Book_Link.bookshelf_id)
+            .join(Book, Book.book_id == Shelf_Book.book_id)
+            .where(Custom_Shelf.end_user_id == owner_id)
+            .order_by(Custom_Shelf.shelf_id, Shelf_Book.bookshelf_id)
+        )
+        for row in _stream(db, custom_books):
+            yield {"type": "custom_shelf_book", "shelf": row.shelf_name, "google_book_id": row.google_book_id,
+                   "title": row.title}
+
+        sections = (
+            select(Book.google_book_id, Book.title, Log_Section.section_name, Log_Section.entry_text,
+                   Log_Section.original_date, Log_Section.edited_date)
+            .join(Journal_Entry, Journal_Entry.journal_entry_id == Log_Section.journal_entry_id)
+            .join(Book, Book.book_id == Journal_Entry.book_id)
+            .where(Journal_Entry.end_user_id == owner_id)
+            .order_by(Log_Section.journal_entry_id, Log_Section.original_date)
+        )
+        for row in _stream(db, sections):
+            yield {
+                "type": "journal_section",
+                "google_book_id": row.google_book_id,
+                "title": row.title,
+                "section_name": row.section_name,
+                "entry_text": row.entry_text,
+                "original_date": row.original_date,
+                "edited_date": row.edited_date,
+            }
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def to_ndjson(records: Iterable[dict]) -> Iterator[bytes]:
+    for record in records:
+        yield (json.dumps(record, default=_json_default) + "\n").encode("utf-8")
+
+
+def to_csv(records: Iterable[dict]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+    writer.writeheader()
+    yield buffer.getvalue().encode("utf-8")
+    buffer.seek(0)
+    buffer.truncate()
+    for record in records:
+        for key in ("authors", "categories"):
+            if isinstance(record.get(key), list):
+                record[key] = "; ".join(record[key])
+        for key in ("date_added", "date_read", "original_date", "edited_date"):
+            if isinstance(record.get(key), datetime):
+                record[key] = record[key].isoformat()
+        writer.writerow(record)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def coalesced(chunks: Iterable[bytes], size: int = 64 * 1024) -> Iterator[bytes]:
+    """This function groups small pieces so the response is not sent one row per write."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def gzipped(chunks: Iterable[bytes], flush_bytes: int = 64 * 1024) -> Iterator[bytes]:
+    """This function gzips a byte stream, handing out compressed data every flush_bytes of input."""
+    compressor = zlib.compressobj(wbits=31)
+    pending = 0
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_bytes:
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,65 @@
+"""This module contains the reading goal progress rules
+
+Progress is counted from shelf events instead of being sent by the client: when
+books land on the Read shelf every active goal whose date window holds the
+finishing date moves forward, and the shelf row is linked to the goal ending
+soonest. Active goals are read through the (end_user_id, active) index, a user
+only ever has a handful of them.
+"""
+from collections import Counter
+from datetime import datetime
+from typing import Iterable
+
+from sqlalchemy import Integer, and_, column, update, values
+from sqlmodel import select
+
+from models import Reading_Goal
+
+
+def active_goals_statement(owner_id: int):
+    return (
+        select(Reading_Goal)
+        .where(Reading_Goal.end_user_id == owner_id, Reading_Goal.active == True)
+        .order_by(Reading_Goal.end_date.nulls_last(), Reading_Goal.reading_goal_id)
+    )
+
+
+def counts_towards(goal: Reading_Goal, finished: datetime) -> bool:
+    return (goal.start_date is None or goal.start_date <= finished) and \
+        (goal.end_date is None or finished <= goal.end_date)
+
+
+def goal_for(goals: list[Reading_Goal], finished: datetime) -> int | None:
+    """This function picks the goal a newly read book is linked to, goals come ordered by end date."""
+    for goal in goals:
+        if counts_towards(goal, finished):
+            return goal.reading_goal_id
+    return None
+
+
+def progress_counts(goals: list[Reading_Goal], finished_dates: Iterable[datetime]) -> Counter:
+    counts = Counter()
+    for finished in finished_dates:
+        for goal in goals:
+            if counts_towards(goal, finished):
+                counts[goal.reading_goal_id] += 1
+    return counts
+
+
+def progress_update(counts: Counter):
+    """This function builds one UPDATE moving every goal in counts, a goal that reaches its target stops being active."""
+    if not counts:
+        return None
+    increments = values(
+        column("reading_goal_id", Integer), column("increment", Integer), name="increments"
+    ).data(list(counts.items()))
+    # Both sides read the old progress, the increment happens in the database so concurrent writers add up
+    return (
+        update(Reading_Goal)
+        .where(Reading_Goal.reading_goal_id == increments.c.reading_goal_id)
+        .values(
+            progress=Reading_Goal.progress + increments.c.increment,
+            active=and_(Reading_Goal.active, Reading_Goal.progress + increments.c.increment < Reading_Goal.target),
+        )
+        .execution_options(synchronize_session=False)
+    )
@@ -0,0 +1,347 @@
+"""This module contains the Goodreads / StoryGraph CSV import pipeline
+
+An upload is spooled to disk and processed in a background thread as a chain of
+generators (read -> normalize -> dedupe -> chunk), so memory stays flat whatever
+the size of the library. Each chunk is written in its own transaction together
+with the job checkpoint, which is what lets a failed import resume where it stopped.
+"""
+import csv
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterable, Iterator, NamedTuple
+
+from dotenv import load_dotenv
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, select
+
+import crud
+import database
+from cache import remember_book
+from models import Book, Imported_Book, Import_Job, Import_Status, Shelf, Shelf_Book, Shelf_Kind
+from goals import active_goals_statement, goal_for, progress_counts, progress_update
+from stats import ReadBook, counters_upsert, read_book_counters
+
+load_dotenv()
+
+IMPORT_DIR = os.getenv("IMPORT_DIR", os.path.join(tempfile.gettempdir(), "radreads-imports"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "1"))
+# A running job that has not checkpointed for this long is treated as abandoned
+IMPORT_STALE_SECONDS = int(os.getenv("IMPORT_STALE_SECONDS", "300"))
+
+logger = logging.getLogger(__name__)
+_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="import")
+
+SHELF_NAMES = {
+    "read": Shelf_Kind.READ,
+    "currently-reading": Shelf_Kind.CURRENT,
+    "to-read": Shelf_Kind.TO_READ,
+    "did-not-finish": Shelf_Kind.DROPPED,
+    "dnf": Shelf_Kind.DROPPED,
+    "dropped": Shelf_Kind.DROPPED,
+}
+DATE_FORMATS = ("%Y/%m/%d", "%Y-%m-%d", "%m/%d/%Y")
+
+
+class ImportRow(NamedTuple):
+    row_number: int
+    google_book_id: str
+    title: str
+    authors: list
+    number_of_pages: int
+    published_date: str | None
+    kind: Shelf_Kind
+    original_shelf: str
+    date_read: datetime | None
+    rating: float | None
+    review: str
+
+
+def detect_source(header: list[str]) -> str:
+    """This function tells which service exported a CSV from its header row."""
+    columns = set(header)
+    if "Exclusive Shelf" in columns:
+        return "goodreads"
+    if "Read Status" in columns:
+        return "storygraph"
+    if "google_book_id" in columns:
+        return "radreads"
+    raise ValueError("Unrecognised CSV, expected a Goodreads or StoryGraph export")
+
+
+def _clean_isbn(value: str | None) -> str:
+    # Goodreads wraps ISBNs as ="9780..." so spreadsheets keep the leading zeros
+    return (value or "").strip().lstrip("=").strip('"').replace("-", "")
+
+
+def _parse_date(value: str | None) -> datetime | None:
+    value = (value or "").strip()
+    # StoryGraph "Dates Read" can hold a range, the last date is when the book was finished
+    value = value.split("-")[-1].strip() if value.count("/") > 2 else value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_number(value: str | None, cast):
+    try:
+        return cast(value) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def read_rows(path: str, start_after: int = 0) -> Iterator[tuple[int, dict]]:
+    """This function yields (row_number, row) pairs, skipping rows a previous run already committed."""
+    with open(path, newline="", encoding="utf-8-sig") as csv_file:
+        for row_number, row in enumerate(csv.DictReader(csv_file), start=1):
+            if row_number > start_after:
+                yield row_number, row
+
+
+def normalize(rows: Iterable[tuple[int, dict]], source: str) -> Iterator[ImportRow]:
+    """This function maps each export format onto ImportRow, rows without a title are dropped."""
+    for row_number, row in rows:
+        title = (row.get("Title") or row.get("title") or "").strip()
+        if not title:
+            continue
+        match source:
+            case "goodreads":
+                authors = [row.get("Author", "")] + (row.get("Additional Authors") or "").split(",")
+                isbn = _clean_isbn(row.get("ISBN13")) or _clean_isbn(row.get("ISBN"))
+                fallback_id = f"goodreads:{row['Book Id']}" if row.get("Book Id") else None
+                original_shelf = row.get("Exclusive Shelf") or ""
+                date_read = _parse_date(row.get("Date Read"))
+                rating = _parse_number(row.get("My Rating"), float) or None
+                review = row.get("My Review") or ""
+                pages = _parse_number(row.get("Number of Pages"), int)
+                published = row.get("Original Publication Year") or row.get("Year Published")
+            case "storygraph":
+                authors = (row.get("Authors") or "").split(",")
+                isbn = _clean_isbn(row.get("ISBN/UID"))
+                fallback_id = None
+                original_shelf = row.get("Read Status") or ""
+                date_read = _parse_date(row.get("Last Date Read") or row.get("Dates Read"))
+                rating = _parse_number(row.get("Star Rating"), float)
+                review = row.get("Review") or ""
+                pages = None
+                published = None
+            case _:
+                authors = (row.get("authors") or "").split(",")
+                isbn = ""
+                fallback_id = row.get("google_book_id")
+                original_shelf = row.get("shelf") or ""
+                date_read = _parse_date(row.get("date_read"))
+                rating = _parse_number(row.get("rating"), float)
+                review = row.get("review") or ""
+                pages = _parse_number(row.get("number_of_pages"), int)
+                published = row.get("published_date")
+        authors = [author.strip() for author in authors if author and author.strip()]
+        if isbn:
+            google_book_id = f"isbn:{isbn}"
+        elif fallback_id:
+            google_book_id = fallback_id
+        else:
+            digest = hashlib.sha1(f"{title}|{','.join(authors)}".lower().encode("utf-8")).hexdigest()
+            google_book_id = f"import:{digest[:20]}"
+        yield ImportRow(
+            row_number=row_number,
+            google_book_id=google_book_id,
+            title=title,
+            authors=authors,
+            number_of_pages=pages or 0,
+            published_date=published or None,
+            kind=SHELF_NAMES.get(original_shelf.strip().lower(), Shelf_Kind.TO_READ),
+            original_shelf=original_shelf,
+            date_read=date_read,
+            rating=rating,
+            review=review,
+        )
+
+
+def dedupe(records: Iterable[ImportRow], stats: dict) -> Iterator[ImportRow]:
+    """This function drops repeated books within one file, the first occurrence wins."""
+    seen = set()
+    for record in records:
+        if record.google_book_id in seen:
+            stats["duplicates_skipped"] += 1
+            continue
+        seen.add(record.google_book_id)
+        yield record
+
+
+def chunked(records: Iterable[ImportRow], size: int) -> Iterator[list[ImportRow]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def count_rows(path: str) -> int:
+    with open(path, newline="", encoding="utf-8-sig") as csv_file:
+        return max(sum(1 for _ in csv.reader(csv_file)) - 1, 0)
+
+
+def write_chunk(db: Session, job: Import_Job, shelf_ids: dict, chunk: list[ImportRow], last_row: int, stats: dict):
+    """This function writes one chunk of books, shelf links and the job checkpoint in a single transaction."""
+    book_rows = [
+        {
+            "google_book_id": record.google_book_id,
+            "title": record.title,
+            "authors": record.authors,
+            "description": "",
+            "number_of_pages": record.number_of_pages,
+            "categories": [],
+            "published_date": record.published_date,
+        }
+        for record in chunk
+    ]
+    db.execute(pg_insert(Book).values(book_rows).on_conflict_do_nothing(index_elements=["google_book_id"]))
+    # Plain columns, unlike Book instances they are not expired by the commit before remember_book reads them
+    statement = select(*(getattr(Book, field) for field in sorted(crud.CACHED_BOOK_FIELDS))).where(
+        Book.google_book_id.in_([record.google_book_id for record in chunk])
+    )
+    books = {book.google_book_id: book for book in db.exec(statement).all()}
+    book_ids = {google_book_id: book.book_id for google_book_id, book in books.items()}
+
+    goals = db.exec(active_goals_statement(job.end_user_id)).all()
+    link_rows = [
+        {
+            "shelf_id": shelf_ids[record.kind],
+            "book_id": book_ids[record.google_book_id],
+            "date_added": datetime.now(),
+            "date_read": record.date_read,
+            "rating": record.rating,
+            "reading_goal_id": (
+                goal_for(goals, record.date_read or datetime.now()) if record.kind == Shelf_Kind.READ else None
+            ),
+        }
+        for record in chunk
+    ]
+    added = db.execute(
+        pg_insert(Shelf_Book).values(link_rows).on_conflict_do_nothing()
+        .returning(Shelf_Book.book_id, Shelf_Book.shelf_id)
+    ).all()
+    imported_rows = [
+        {
+            "book_id": book_ids[record.google_book_id],
+            "transfer_history_id": job.transfer_history_id,
+            "review": record.review,
+            "date_read": record.date_read,
+            "rating": record.rating,
+            "original_shelf": record.original_shelf,
+        }
+        for record in chunk
+    ]
+    db.execute(pg_insert(Imported_Book).values(imported_rows).on_conflict_do_nothing())
+
+    if added:
+        touched = {row.shelf_id for row in added}
+        kinds = [kind for kind, shelf_id in shelf_ids.items() if shelf_id in touched]
+        db.execute(crud.collection_version_upsert(job.end_user_id, *(crud.shelf_collection(kind) for kind in kinds)))
+        added_read = {row.book_id for row in added if row.shelf_id == shelf_ids[Shelf_Kind.READ]}
+        # The stored catalogue values, a book the catalogue already knew keeps its pages, authors and categories
+        read_books = [
+            ReadBook(book.number_of_pages, book.authors, book.categories, record.date_read, record.rating)
+            for record in chunk
+            if record.kind == Shelf_Kind.READ and (book := books[record.google_book_id]).book_id in added_read
+        ]
+        if read_books:
+            db.execute(counters_upsert(job.end_user_id, read_book_counters(read_books)))
+            counts = progress_counts(goals, [book.date_read or datetime.now() for book in read_books])
+            if counts:
+                db.execute(progress_update(counts))
+                db.execute(crud.collection_version_upsert(job.end_user_id, crud.GOALS_COLLECTION))
+
+    stats["books_imported"] += len(added)
+    db.execute(
+        update(Import_Job).where(Import_Job.import_job_id == job.import_job_id)
+        .values(rows_read=last_row, updated_at=datetime.now(), **stats)
+    )
+    db.commit()
+    for book in books.values():
+        remember_book(book)
+
+
+def run_import(job_id: int):
+    """This function processes an import job from its checkpoint to the end of the file."""
+    with Session(database.engine) as db:
+        # Claim the job, a second worker handed the same id finds it already running
+        claimed = db.execute(
+            update(Import_Job)
+            .where(Import_Job.import_job_id == job_id, Import_Job.status == Import_Status.PENDING)
+            .values(status=Import_Status.RUNNING, updated_at=datetime.now())
+            .returning(Import_Job.import_job_id)
+        ).first()
+        db.commit()
+        if not claimed:
+            return
+        job = db.get(Import_Job, job_id)
+        try:
+            if job.rows_total is None:
+                job.rows_total = count_rows(job.file_path)
+                db.add(job)
+                db.commit()
+            shelves = db.exec(select(Shelf).where(Shelf.end_user_id == job.end_user_id)).all()
+            shelf_ids = {shelf.kind: shelf.shelf_id for shelf in shelves}
+            stats = {"books_imported": job.books_imported, "duplicates_skipped": job.duplicates_skipped}
+
+            records = dedupe(normalize(read_rows(job.file_path, job.rows_read), job.source), stats)
+            for chunk in chunked(records, IMPORT_CHUNK_SIZE):
+                write_chunk(db, job, shelf_ids, chunk, chunk[-1].row_number, stats)
+
+            db.execute(
+                update(Import_Job).where(Import_Job.import_job_id == job_id)
+                .values(status=Import_Status.COMPLETED, rows_read=job.rows_total, updated_at=datetime.now(), **stats)
+            )
+            db.commit()
+            os.remove(job.file_path)
+        except Exception as error:
+            logger.exception("Import %s failed", job_id)
+            db.rollback()
+            db.execute(
+                update(Import_Job).where(Import_Job.import_job_id == job_id)
+                .values(status=Import_Status.FAILED, error=str(error)[:500], updated_at=datetime.now())
+            )
+            db.commit()
+
+
+def start_import(job_id: int):
+    """This function queues an import job on the background worker."""
+    _executor.submit(run_import, job_id)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def save_upload(upload, owner_id: int) -> tuple[str, str]:
+    """This function copies an uploaded CSV to IMPORT_DIR in chunks and returns (path, source)."""
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    handle, path = tempfile.mkstemp(prefix=f"user{owner_id}-", suffix=".csv", dir=IMPORT_DIR)
+    try:
+        written = 0
+        with os.fdopen(handle, "wb") as destination:
+            while block := upload.read(1024 * 1024):
+                written += len(block)
+                if written > IMPORT_MAX_BYTES:
+                    raise UploadTooLarge(f"Imports are limited to {IMPORT_MAX_BYTES} bytes")
+                destination.write(block)
+        with open(path, newline="", encoding="utf-8-sig") as csv_file:
+            source = detect_source(next(csv.reader(csv_file), []))
+    except (UploadTooLarge, ValueError):
+        os.remove(path)
+        raise
+    return path, source
@@ -1,225 +1,691 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlmodel import Session
-import models, crud, security, database
+import asyncio
+import logging
+import os
+import time
+from typing import Literal
+
+from datetime import datetime, timedelta
 
-app = FastAPI()
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, UploadFile, status
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
+import models, crud, security, database, etags, exports, imports, metrics, tokens
+import cache_policy, response_compression
+from cache import CachedUser, catalogue_cache, user_cache
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+
+# orjson renders the validated response several times faster than the stdlib encoder
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(cache_policy.CacheControlMiddleware)
+# Added last so it is the outermost layer and sees the final headers
+app.add_middleware(response_compression.CompressionMiddleware)
+metrics.instrument_engine(database.engine)
+metrics.instrument_engine(database.async_engine.sync_engine)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHELVES = {
+    "tbr": models.Shelf_Kind.TO_READ,
+    "dropped": models.Shelf_Kind.DROPPED,
+    "current": models.Shelf_Kind.CURRENT,
+    "read": models.Shelf_Kind.READ,
+}
+MAX_BATCH_SIZE = 500
+SHELF_LISTING_INCLUDES = {"counts", "preview"}
+# SQL statements a route may issue, whatever the size of the data (see QUERY_BUDGET_MODE).
+# A cache miss on the current user costs one of them.
+LISTING_BUDGET = Depends(metrics.query_budget(3))
+LOOKUP_BUDGET = Depends(metrics.query_budget(2))
+# User, shelf, catalogue upsert and lookup, active goals, links, counters, goals and the version bump
+BATCH_BUDGET = Depends(metrics.query_budget(9))
+_background_tasks = set()
+
+# Listings revalidate with their ETag, stale-while-revalidate lets the client show its copy meanwhile
+LISTING_CACHE = cache_policy.CachePolicy(
+    max_age=int(os.getenv("LISTING_CACHE_MAX_AGE", "0")),
+    stale_while_revalidate=int(os.getenv("LISTING_CACHE_STALE_SECONDS", "60")),
+)
+STATS_CACHE = cache_policy.CachePolicy(max_age=int(os.getenv("STATS_CACHE_MAX_AGE", "60")), stale_while_revalidate=300)
+# Recommendations only change when the offline job runs
+RECOMMENDATIONS_CACHE = cache_policy.CachePolicy(
+    max_age=int(os.getenv("RECOMMENDATIONS_CACHE_MAX_AGE", "3600")), stale_while_revalidate=86400
+)
+cache_policy.register(
+    LISTING_CACHE,
+    "/shelves/me", "/shelves/tbr", "/shelves/dropped", "/shelves/read", "/shelves/current", "/shelves/custom/{name}",
+    "/goals/me", "/goals/active", "/goals/completed",
+)
+# No collection version behind these, without an ETag a stale copy could not be revalidated
+cache_policy.register(
+    cache_policy.NO_CACHE,
+    "/defaultShelves/me", "/books/search", "/journals/me", "/journals/{journal_entry_id}/sections",
+    "/journals/{journal_entry_id}/sections/{log_section_id}",
+)
+cache_policy.register(STATS_CACHE, "/stats/me")
+cache_policy.register(RECOMMENDATIONS_CACHE, "/recommendations/me")
+cache_policy.register(cache_policy.NO_STORE, "/users/me", "/export", "/imports/{job_id}", "/metrics", "/health/db")
+cache_policy.register(cache_policy.NO_STORE, "/register/", "/login", "/token/refresh", "/logout", "/logout/all",
+                      "/users/me/password", methods=("POST",))
 
 @app.on_event("startup")
 def on_startup():
+    tokens.load_key_set()
     database.init_db()
+    security.start_password_pool()
+
+@app.on_event("startup")
+async def start_revocation_reload():
+    task = asyncio.create_task(reload_revocations())
+    _background_tasks.add(task)
+
+@app.on_event("shutdown")
+def on_shutdown():
+    security.shutdown_password_pool()
+    for task in _background_tasks:
+        task.cancel()
+
+
+async def reload_revocations():
+    """This function keeps the in-process revocation list in step with the database."""
+    while True:
+        started_at = time.monotonic()
+        try:
+            async with AsyncSession(database.async_engine, expire_on_commit=False) as db:
+                tokens.replace_revoked(await crud.get_revoked_token_ids(db), started_at)
+        except SQLAlchemyError:
+            logger.exception("Could not reload revoked tokens")
+        await asyncio.sleep(tokens.REVOCATION_REFRESH_SECONDS)
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to Rad Reads"}
 
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(database.get_session),
-) -> models.End_User:
-    email = security.decode_access_token(token)
-    if not email:
+@app.get("/health/db")
+async def database_health(db: AsyncSession = Depends(database.get_async_session)):
+    try:
+        await db.execute(text("SELECT 1"))
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail={"database": "unavailable", "pools": database.pool_status()})
+    return {"database": "ok", "pools": database.pool_status()}
+
+
+def runtime_metrics() -> list[str]:
+    caches = {"user": user_cache.stats(), "catalogue": catalogue_cache.stats()}
+    lines = []
+    for field in ("size", "hits", "misses", "evictions"):
+        lines += metrics.gauge_family(f"cache_{field}", f"In-process cache {field}", "cache",
+                                      {name: stats[field] for name, stats in caches.items()})
+    pools = {name: pool for name, pool in database.pool_status().items() if pool["pool"] == "internal"}
+    for field in ("checked_out", "overflow"):
+        lines += metrics.gauge_family(f"db_pool_{field}", f"Connection pool {field.replace('_', ' ')}", "engine",
+                                      {name: pool[field] for name, pool in pools.items()})
+    lines += metrics.gauge_family("password_jobs_pending", "Password hashing jobs queued or running", "pool",
+                                  {"bcrypt": security.password_pool_stats()["pending"]})
+    return lines
+
+
+metrics.COLLECTORS.append(runtime_metrics)
+
+
+@app.exception_handler(metrics.QueryBudgetExceeded)
+async def query_budget_exceeded(request: Request, error: metrics.QueryBudgetExceeded):
+    return JSONResponse(status_code=500, content={"detail": str(error)})
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+async def get_token_claims(token: str = Depends(oauth2_scheme)) -> tokens.TokenClaims:
+    claims = tokens.verify_access_token(token)
+    if claims is None:
         raise HTTPException(status_code=401, detail="Invalid token")
-    user = crud.get_user_by_email(db, email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return user
+    # An in-memory set lookup, the list is reloaded in the background
+    if tokens.is_revoked(claims.jti):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return claims
+
+
+async def get_current_user(
+    claims: tokens.TokenClaims = Depends(get_token_claims),
+    db: AsyncSession = Depends(database.get_async_session),
+) -> models.EndUserRead:
+    if tokens.AUTH_STATELESS and claims.email:
+        # The signature vouches for the principal, no cache or database involved
+        return models.EndUserRead(end_user_id=claims.user_id, email=claims.email, username=claims.username)
+    # The session only opens a connection when it is used, so a cache hit costs no round trip
+    cached = user_cache.get(claims.user_id)
+    if cached is None:
+        db_user = await crud.get_user(db, claims.user_id)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        cached = CachedUser(models.EndUserRead.model_validate(db_user), db_user.token_version)
+        user_cache.set(claims.user_id, cached)
+    if claims.version != cached.token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return cached.user
+
+
+async def not_modified_response(
+        request: Request,
+        response: Response,
+        db: AsyncSession,
+        owner_id: int,
+        collection: str,
+) -> Response | None:
+    # One primary key lookup decides whether the listing has to be loaded at all
+    version = await crud.get_collection_version(db, owner_id, collection)
+    etag = etags.collection_etag(request, owner_id, collection, version)
+    if etags.is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
+
+def book_fields(
+        fields: str | None = Query(None, description=f"Comma separated, any of: {', '.join(models.BOOK_LIST_FIELDS)}"),
+) -> tuple[str, ...]:
+    # Listings read and send only these columns, the summary leaves out the long description
+    if not fields:
+        return models.BOOK_SUMMARY_FIELDS
+    requested = tuple(dict.fromkeys(part.strip() for part in fields.split(",") if part.strip()))
+    if unknown := set(requested) - set(models.BOOK_LIST_FIELDS):
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested or models.BOOK_SUMMARY_FIELDS
 
 @app.post("/register/", response_model=models.EndUserRead)
-def register(user_in: models.EndUserCreate, db: Session = Depends(database.get_session)):
-    if crud.get_user_by_email(db, user_in.email):
+async def register(user_in: models.EndUserCreate, db: AsyncSession = Depends(database.get_async_session)):
+    if await crud.get_user_by_email(db, user_in.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    user = crud.create_user(db, user_in)
+    # bcrypt runs in the password worker pool so it never holds a request thread
+    password_hash = await security.get_password_hash_async(user_in.password)
+    user = await crud.create_user(db, user_in, password_hash)
     return user
 
 @app.post("/login", response_model=models.Token)
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(database.get_session),
+    db: AsyncSession = Depends(database.get_async_session),
 ):
-    user = crud.get_user_by_email(db, form_data.username)
-    if not user or not security.verify_password(form_data.password, user.password_hash):
+    user = await crud.get_user_by_email(db, form_data.username)
+    if not user or not await security.verify_password_async(form_data.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Incorrect email or password")
-    token = security.create_access_token(user.email)
-    return {"access_token": token, "token_type": "bearer"}
+    if security.needs_rehash(user.password_hash):
+        password_hash = await security.get_password_hash_async(form_data.password)
+        await crud.update_password_hash(db, user, password_hash)
+    return token_response(user, await crud.create_refresh_token(db, user.end_user_id))
+
+
+def token_response(user: models.End_User, refresh_token: str) -> dict:
+    return {
+        "access_token": tokens.create_access_token(user.end_user_id, user.token_version, user.email, user.username),
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": tokens.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+
+@app.post("/token/refresh", response_model=models.Token)
+async def refresh_access_token(
+    refresh_in: models.RefreshRequest,
+    db: AsyncSession = Depends(database.get_async_session),
+):
+    # No password check and so no bcrypt, the refresh token is spent and replaced
+    user, refresh_token = await crud.rotate_refresh_token(db, refresh_in.refresh_token)
+    return token_response(user, refresh_token)
+
+
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    refresh_in: models.RefreshRequest | None = None,
+    claims: tokens.TokenClaims = Depends(get_token_claims),
+    db: AsyncSession = Depends(database.get_async_session),
+):
+    await crud.revoke_tokens(db, claims.user_id, claims.jti, claims.expires_at,
+                             refresh_in.refresh_token if refresh_in else None)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@app.post("/logout/all", status_code=status.HTTP_204_NO_CONTENT)
+async def logout_everywhere(
+    current_user: models.EndUserRead = Depends(get_current_user),
+    db: AsyncSession = Depends(database.get_async_session),
+):
+    await crud.end_all_sessions(db, current_user.end_user_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@app.post("/users/me/password", response_model=models.Token)
+async def change_password(
+    password_in: models.PasswordChange,
+    current_user: models.EndUserRead = Depends(get_current_user),
+    db: AsyncSession = Depends(database.get_async_session),
+):
+    user = await crud.get_user(db, current_user.end_user_id)
+    if not user or not await security.verify_password_async(password_in.current_password, user.password_hash):
+        raise HTTPException(status_code=401, detail="Incorrect password")
+    password_hash = await security.get_password_hash_async(password_in.new_password)
+    # Every other session ends with the old password, this one continues on fresh tokens
+    user = await crud.end_all_sessions(db, user.end_user_id, password_hash)
+    return token_response(user, await crud.create_refresh_token(db, user.end_user_id))
 
 @app.get("/users/me", response_model=models.EndUserRead)
-def read_users_me(current_user: models.End_User = Depends(get_current_user)):
+async def read_users_me(current_user: models.EndUserRead = Depends(get_current_user)):
     return current_user
 
 @app.post("/shelf/", response_model=models.Custom_Shelf)
-def create_shelf(
+async def create_shelf(
     shelf_in: models.CustomShelfCreate,
-    current_user: models.End_User = Depends(get_current_user),
-    db: Session = Depends(database.get_session),
+    current_user: models.EndUserRead = Depends(get_current_user),
+    db: AsyncSession = Depends(database.get_async_session),
 ):
-    return crud.create_custom_shelf(db, current_user.end_user_id, shelf_in)
-
-@app.get("/shelves/me")
-def read_shelves(
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user)
+    return await crud.create_custom_shelf(db, current_user.end_user_id, shelf_in)
+
+@app.get("/shelves/me", response_model=list[models.CustomShelfRead], response_model_exclude_none=True,
+         dependencies=[LISTING_BUDGET])
+async def read_shelves(
+        request: Request,
+        response: Response,
+        include: str | None = Query(None, description="Comma separated: counts, preview"),
+        preview_size: int = Query(4, ge=1, le=20),
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user)
 ):
-    shelves = crud.get_custom_shelves(db, current_user.end_user_id)
-    return [shelf for shelf in shelves]
+    included = {part.strip() for part in include.split(",") if part.strip()} if include else set()
+    if unknown := included - SHELF_LISTING_INCLUDES:
+        raise HTTPException(status_code=400, detail=f"Unknown include: {', '.join(sorted(unknown))}")
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.CUSTOM_SHELVES_COLLECTION):
+        return not_modified
+    # Counts and previews come back in the same statement as the shelves, a home screen is one listing query
+    return await crud.get_custom_shelf_listing(
+        db, current_user.end_user_id, "counts" in included, preview_size if "preview" in included else 0
+    )
 
 @app.get("/defaultShelves/me")
-def read_all_default_shelves(
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+async def read_all_default_shelves(
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
 ):
-    shelves = [crud.get_tbr_shelf(db, current_user.end_user_id),
-               crud.get_dropped_shelf(db, current_user.end_user_id),
-               crud.get_current_shelf(db, current_user.end_user_id),
-               crud.get_read_shelf(db, current_user.end_user_id)]
-    return shelves
+    return await crud.get_default_shelves(db, current_user.end_user_id)
 
 
 @app.post("/shelves/tbr")
-def add_book_to_tbr_shelf(
+async def add_book_to_tbr_shelf(
         book_in: models.Book,
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user)
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user)
 ):
     # Get the user's TBR shelf
-    shelf = crud.get_tbr_shelf(db, current_user.end_user_id)
-    print("BOOK ID ADDING: ", book_in.google_book_id)
-    return crud.add_book_to_chosen_shelf(db, book_in, models.To_Read_Shelf(), shelf.shelf_id)
+    shelf = await crud.get_shelf(db, current_user.end_user_id, models.Shelf_Kind.TO_READ)
+    logger.debug("Adding book %s to the TBR shelf", book_in.google_book_id)
+    return await crud.add_book_to_chosen_shelf(db, book_in, shelf)
 
 
 @app.post("/shelves/dropped")
-def add_book_to_dropped_shelf(
+async def add_book_to_dropped_shelf(
         book_in: models.Book,
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user)
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user)
 ):
-    shelf = crud.get_dropped_shelf(db, current_user.end_user_id)
-    return crud.add_book_to_chosen_shelf(db, book_in, models.Dropped_Shelf(), shelf.shelf_id)
+    shelf = await crud.get_shelf(db, current_user.end_user_id, models.Shelf_Kind.DROPPED)
+    return await crud.add_book_to_chosen_shelf(db, book_in, shelf)
 
 
 @app.post("/shelves/current")
-def add_book_to_current_shelf(
+async def add_book_to_current_shelf(
         book_in: models.Book,
 
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user)
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user)
 ):
-    shelf = crud.get_current_shelf(db, current_user.end_user_id)
-    return crud.add_book_to_chosen_shelf(db, book_in, models.Current_Shelf(), shelf.shelf_id)
+    shelf = await crud.get_shelf(db, current_user.end_user_id, models.Shelf_Kind.CURRENT)
+    return await crud.add_book_to_chosen_shelf(db, book_in, shelf)
 
 
 @app.post("/shelves/read")
-def add_book_to_read_shelf(
+async def add_book_to_read_shelf(
         book_in: models.Book,
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user)
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user)
 ):
     # Get the user's TBR shelf
-    shelf = crud.get_read_shelf(db, current_user.end_user_id)
-    return crud.add_book_to_chosen_shelf(db, book_in, models.Read_Shelf(), shelf.shelf_id)
+    shelf = await crud.get_shelf(db, current_user.end_user_id, models.Shelf_Kind.READ)
+    return await crud.add_book_to_chosen_shelf(db, book_in, shelf)
+
+
+@app.post("/shelves/{shelf}/books:batch", response_model=list[models.BookBatchResult],
+          dependencies=[BATCH_BUDGET])
+async def add_books_to_shelf_batch(
+        shelf: Literal["tbr", "dropped", "current", "read"],
+        books_in: list[models.Book],
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user)
+):
+    if len(books_in) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {MAX_BATCH_SIZE} books")
+    return await crud.add_books_to_shelf_batch(db, current_user.end_user_id, books_in, DEFAULT_SHELVES[shelf])
 
 
 @app.post("/shelves/custom/{shelf_name}")
-def add_book_to_custom_shelf(
+async def add_book_to_custom_shelf(
         shelf_name: str,
         book_in: models.Book,
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
 ):
-    # Get the user's TBR shelf
-    shelves = crud.get_custom_shelves(db, current_user.end_user_id)
-    for shelf in shelves:
-        if shelf.shelf_name == shelf_name:
-            return crud.add_book_to_chosen_shelf(db, book_in, models.Custom_Shelf(), shelf)
-
-    return None
-
-
-@app.get("/shelves/tbr")
-def get_books_from_current_shelf(
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+    shelf = await crud.get_custom_shelf(db, current_user.end_user_id, shelf_name)
+    return await crud.add_book_to_chosen_shelf(db, book_in, shelf)
+
+
+@app.get("/books/search", response_model=models.BookPage, response_model_exclude_unset=True,
+         dependencies=[LOOKUP_BUDGET])
+async def search_my_books(
+        q: str | None = None,
+        author: str | None = None,
+        category: str | None = None,
+        shelf: Literal["tbr", "dropped", "current", "read"] | None = None,
+        limit: int = Query(20, ge=1, le=100),
+        cursor: str | None = None,
+        fields: tuple[str, ...] = Depends(book_fields),
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
 ):
-    return crud.get_books(db, current_user.end_user_id, models.To_Read_Shelf())
-
-
-@app.get("/shelves/dropped")
-def get_books_from_dropped_shelf(
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+    kind = DEFAULT_SHELVES[shelf] if shelf else None
+    return await crud.search_books(db, current_user.end_user_id, q, author, category, kind, limit, cursor, fields)
+
+
+@app.get("/shelves/tbr", response_model=models.BookPage, response_model_exclude_unset=True,
+         dependencies=[LISTING_BUDGET])
+async def get_books_from_current_shelf(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+        limit: int = Query(50, ge=1, le=200),
+        cursor: str | None = None,
+        sort: Literal["added", "title"] = "added",
+        fields: tuple[str, ...] = Depends(book_fields),
 ):
-    return crud.get_books(db, current_user.end_user_id, models.Dropped_Shelf())
-
-@app.get("/shelves/read")
-def get_books_from_current_shelf(
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+    kind = models.Shelf_Kind.TO_READ
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.shelf_collection(kind)):
+        return not_modified
+    return await crud.get_books(db, current_user.end_user_id, kind, limit, cursor, sort, fields)
+
+
+@app.get("/shelves/dropped", response_model=models.BookPage, response_model_exclude_unset=True,
+         dependencies=[LISTING_BUDGET])
+async def get_books_from_dropped_shelf(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+        limit: int = Query(50, ge=1, le=200),
+        cursor: str | None = None,
+        sort: Literal["added", "title"] = "added",
+        fields: tuple[str, ...] = Depends(book_fields),
 ):
-    return crud.get_books(db, current_user.end_user_id, models.Read_Shelf())
+    kind = models.Shelf_Kind.DROPPED
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.shelf_collection(kind)):
+        return not_modified
+    return await crud.get_books(db, current_user.end_user_id, kind, limit, cursor, sort, fields)
+
+@app.get("/shelves/read", response_model=models.BookPage, response_model_exclude_unset=True,
+         dependencies=[LISTING_BUDGET])
+async def get_books_from_current_shelf(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+        limit: int = Query(50, ge=1, le=200),
+        cursor: str | None = None,
+        sort: Literal["added", "title"] = "added",
+        fields: tuple[str, ...] = Depends(book_fields),
+):
+    kind = models.Shelf_Kind.READ
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.shelf_collection(kind)):
+        return not_modified
+    return await crud.get_books(db, current_user.end_user_id, kind, limit, cursor, sort, fields)
 
 
-@app.get("/shelves/custom/{name}")
-def get_books_from_current_shelf(
+@app.get("/shelves/custom/{name}", response_model=list[models.BookListItem], response_model_exclude_unset=True,
+         dependencies=[LISTING_BUDGET])
+async def get_books_from_current_shelf(
         name: str,
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
-
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+        fields: tuple[str, ...] = Depends(book_fields),
 ):
-    return crud.get_custom_books(db, current_user.end_user_id, name)
-
-
-@app.get("/shelves/current")
-def get_books_from_current_shelf(
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.CUSTOM_SHELVES_COLLECTION):
+        return not_modified
+    return await crud.get_custom_books(db, current_user.end_user_id, name, fields)
+
+
+@app.get("/shelves/current", response_model=models.BookPage, response_model_exclude_unset=True,
+         dependencies=[LISTING_BUDGET])
+async def get_books_from_current_shelf(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+        limit: int = Query(50, ge=1, le=200),
+        cursor: str | None = None,
+        sort: Literal["added", "title"] = "added",
+        fields: tuple[str, ...] = Depends(book_fields),
 ):
-    return crud.get_books(db, current_user.end_user_id, models.Current_Shelf())
+    kind = models.Shelf_Kind.CURRENT
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.shelf_collection(kind)):
+        return not_modified
+    return await crud.get_books(db, current_user.end_user_id, kind, limit, cursor, sort, fields)
 
 
 # PROMPT: can you make fastapi endpoints for reading goals so i can create, view, update, and delete them for the logged-in user? i also want endpoints for all goals, active goals, and completed goals, using my sqlmodel models readinggoalcreate, readinggoalupdate, and readinggoalread
 @app.post("/goals/", response_model=models.ReadingGoalRead)
-def create_goal(goal_in: models.ReadingGoalCreate, db: Session = Depends(database.get_session),
-                current_user: models.End_User = Depends(get_current_user)):
-    return crud.create_reading_goal(db, current_user.end_user_id, goal_in)
+async def create_goal(goal_in: models.ReadingGoalCreate, db: AsyncSession = Depends(database.get_async_session),
+                current_user: models.EndUserRead = Depends(get_current_user)):
+    return await crud.create_reading_goal(db, current_user.end_user_id, goal_in)
 
 
-@app.get("/goals/me", response_model=list[models.ReadingGoalRead])
-def get_my_goals(db: Session = Depends(database.get_session),
-                 current_user: models.End_User = Depends(get_current_user)):
-    return crud.get_reading_goals(db, current_user.end_user_id)
+@app.get("/goals/me", response_model=list[models.ReadingGoalRead], dependencies=[LISTING_BUDGET])
+async def get_my_goals(request: Request, response: Response,
+                 db: AsyncSession = Depends(database.get_async_session),
+                 current_user: models.EndUserRead = Depends(get_current_user)):
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.GOALS_COLLECTION):
+        return not_modified
+    return await crud.get_reading_goals(db, current_user.end_user_id)
 
 
-@app.get("/goals/active", response_model=list[models.ReadingGoalRead])
-def get_active_goals(db: Session = Depends(database.get_session),
-                     current_user: models.End_User = Depends(get_current_user)):
-    return crud.get_active_goals(db, current_user.end_user_id)
+@app.get("/goals/active", response_model=list[models.ReadingGoalRead], dependencies=[LISTING_BUDGET])
+async def get_active_goals(request: Request, response: Response,
+                 db: AsyncSession = Depends(database.get_async_session),
+                 current_user: models.EndUserRead = Depends(get_current_user)):
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.GOALS_COLLECTION):
+        return not_modified
+    return await crud.get_active_goals(db, current_user.end_user_id)
 
 
-@app.get("/goals/completed", response_model=list[models.ReadingGoalRead])
-def get_completed_goals(db: Session = Depends(database.get_session),
-                        current_user: models.End_User = Depends(get_current_user)):
-    return crud.get_completed_goals(db, current_user.end_user_id)
+@app.get("/goals/completed", response_model=list[models.ReadingGoalRead], dependencies=[LISTING_BUDGET])
+async def get_completed_goals(request: Request, response: Response,
+                 db: AsyncSession = Depends(database.get_async_session),
+                 current_user: models.EndUserRead = Depends(get_current_user)):
+    if not_modified := await not_modified_response(
+            request, response, db, current_user.end_user_id, crud.GOALS_COLLECTION):
+        return not_modified
+    return await crud.get_completed_goals(db, current_user.end_user_id)
 
 
 @app.put("/goals/{goal_id}", response_model=models.ReadingGoalRead)
-def update_goal(goal_id: int, goal_in: models.ReadingGoalUpdate, db: Session = Depends(database.get_session),
-                current_user: models.End_User = Depends(get_current_user)):
-    return crud.update_reading_goal(db, current_user.end_user_id, goal_id, goal_in)
+async def update_goal(goal_id: int, goal_in: models.ReadingGoalUpdate, db: AsyncSession = Depends(database.get_async_session),
+                current_user: models.EndUserRead = Depends(get_current_user)):
+    return await crud.update_reading_goal(db, current_user.end_user_id, goal_id, goal_in)
 
 
 @app.delete("/goals/{goal_id}")
-def delete_goal(goal_id: int, db: Session = Depends(database.get_session),
-                current_user: models.End_User = Depends(get_current_user)):
-    return crud.delete_reading_goal(db, current_user.end_user_id, goal_id)
+async def delete_goal(goal_id: int, db: AsyncSession = Depends(database.get_async_session),
+                current_user: models.EndUserRead = Depends(get_current_user)):
+    return await crud.delete_reading_goal(db, current_user.end_user_id, goal_id)
+
+
+@app.get("/stats/me", response_model=models.ReadingStats, dependencies=[LOOKUP_BUDGET])
+async def get_my_reading_stats(
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.get_reading_stats(db, current_user.end_user_id)
+
+
+@app.get("/recommendations/me", response_model=list[models.RecommendationRead], dependencies=[LOOKUP_BUDGET])
+async def get_my_recommendations(
+        limit: int = Query(20, ge=1, le=100),
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.get_recommendations(db, current_user.end_user_id, limit)
 
 
 @app.put("/shelves/custom/{shelf_name}/{new_shelf_name}")
-def update_shelf(
+async def update_shelf(
         shelf_name: str,
         new_shelf_name: str,
-        db: Session = Depends(database.get_session),
-        current_user: models.End_User = Depends(get_current_user),
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.update_custom_shelf_name(db, current_user.end_user_id, shelf_name, new_shelf_name)
+
+
+@app.post("/imports", response_model=models.ImportJobRead, status_code=status.HTTP_202_ACCEPTED)
+async def create_import(
+        file: UploadFile,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    try:
+        path, source = await run_in_threadpool(imports.save_upload, file.file, current_user.end_user_id)
+    except imports.UploadTooLarge as error:
+        raise HTTPException(status_code=413, detail=str(error))
+    except (ValueError, UnicodeDecodeError) as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    job = await crud.create_import_job(db, current_user.end_user_id, source, path)
+    imports.start_import(job.import_job_id)
+    return job
+
+
+@app.get("/imports/{job_id}", response_model=models.ImportJobRead)
+async def get_import(
+        job_id: int,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.get_import_job(db, current_user.end_user_id, job_id)
+
+
+@app.post("/imports/{job_id}/resume", response_model=models.ImportJobRead, status_code=status.HTTP_202_ACCEPTED)
+async def resume_import(
+        job_id: int,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    stale_before = datetime.now() - timedelta(seconds=imports.IMPORT_STALE_SECONDS)
+    job = await crud.claim_import_job(db, current_user.end_user_id, job_id, stale_before)
+    imports.start_import(job.import_job_id)
+    return job
+
+
+@app.get("/export")
+async def export_library(
+        format: Literal["ndjson", "csv"] = "ndjson",
+        gzip: bool = False,
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    # The generator opens its own session, it has to outlive this handler while the body streams
+    records = exports.library_records(current_user.end_user_id)
+    body = exports.to_ndjson(records) if format == "ndjson" else exports.to_csv(records)
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    filename = f"radreads-export.{format}"
+    if gzip:
+        body = exports.gzipped(body)
+        media_type = "application/gzip"
+        filename += ".gz"
+    else:
+        body = exports.coalesced(body)
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.post("/journals/", response_model=models.JournalEntryRead)
+async def create_journal_entry(
+        entry_in: models.JournalEntryCreate,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.create_journal_entry(db, current_user.end_user_id, entry_in)
+
+
+@app.get("/journals/me", response_model=list[models.JournalEntryRead])
+async def get_my_journal_entries(
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.get_journal_entries(db, current_user.end_user_id)
+
+
+@app.post("/journals/{journal_entry_id}/sections", response_model=models.LogSectionSummary)
+async def add_log_section(
+        journal_entry_id: int,
+        section_in: models.LogSectionCreate,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.add_log_section(db, current_user.end_user_id, journal_entry_id, section_in)
+
+
+@app.get("/journals/{journal_entry_id}/sections", response_model=models.LogSectionPage,
+         dependencies=[LOOKUP_BUDGET])
+async def get_log_sections(
+        journal_entry_id: int,
+        limit: int = Query(20, ge=1, le=100),
+        cursor: str | None = None,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.get_log_sections(db, current_user.end_user_id, journal_entry_id, limit, cursor)
+
+
+@app.get("/journals/{journal_entry_id}/sections/{log_section_id}", response_model=models.LogSectionRead)
+async def get_log_section(
+        journal_entry_id: int,
+        log_section_id: int,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
+):
+    return await crud.get_log_section(db, current_user.end_user_id, journal_entry_id, log_section_id)
+
+
+@app.patch("/journals/{journal_entry_id}/sections/{log_section_id}", response_model=models.LogSectionSummary)
+async def update_log_section(
+        journal_entry_id: int,
+        log_section_id: int,
+        section_in: models.LogSectionUpdate,
+        db: AsyncSession = Depends(database.get_async_session),
+        current_user: models.EndUserRead = Depends(get_current_user),
 ):
-    return crud.update_custom_shelf_name(db, current_user.end_user_id, shelf_name, new_shelf_name)
+    return await crud.update_log_section(db, current_user.end_user_id, journal_entry_id, log_section_id, section_in)
@@ -0,0 +1,280 @@
+"""This module contains request and database metrics in the Prometheus text format
+
+MetricsMiddleware is plain ASGI, it times every HTTP request against its route
+template (so /journals/1 and /journals/2 share a series), tracks requests in
+flight and counts responses by status. Cursor events on the engines add the
+number of statements and the time spent in the database to the request being
+served, which is what makes an N+1 query show up as a jump in
+db_queries_per_request for one route.
+
+Routes can also declare a query budget with Depends(query_budget(n)). With
+QUERY_BUDGET_MODE=log a request that issues more statements is logged, with
+raise the statement that goes over the budget fails the request, which is what
+tests and staging should run with.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from dotenv import load_dotenv
+from fastapi import Request
+from sqlalchemy import event
+
+load_dotenv()
+
+# Adds a Server-Timing header (app and db time, query count) to every response
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").strip().lower() in ("1", "true", "yes", "on")
+QUERY_BUDGET_MODES = ("off", "log", "raise")
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "off").strip().lower()
+if QUERY_BUDGET_MODE not in QUERY_BUDGET_MODES:
+    raise RuntimeError(f"QUERY_BUDGET_MODE must be one of {', '.join(QUERY_BUDGET_MODES)}")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+UNMATCHED_ROUTE = "<unmatched>"
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+        # label values -> [per bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def _samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, series in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series):
+                    cumulative += count
+                    bucket_labels = _labels(self.label_names, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {series[-1]}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class RequestStats:
+    """What the database did while one request was being served, and what the route allows."""
+    __slots__ = ("queries", "db_seconds", "budget", "route")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.budget = None
+        self.route = None
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, route: str, budget: int):
+        super().__init__(f"{route} went over its budget of {budget} queries")
+        self.route = route
+        self.budget = budget
+
+
+_request_stats: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("request_stats", default=None)
+
+REQUEST_LABELS = ("method", "route")
+requests_in_flight = Gauge("http_requests_in_flight", "Requests being served right now")
+request_duration = Histogram("http_request_duration_seconds", "Time to serve a request", REQUEST_LABELS)
+responses = Counter("http_responses_total", "Responses sent", REQUEST_LABELS + ("status",))
+request_queries = Histogram("db_queries_per_request", "SQL statements issued while serving a request",
+                            REQUEST_LABELS, QUERY_COUNT_BUCKETS)
+request_db_time = Histogram("db_time_per_request_seconds", "Time spent waiting on SQL while serving a request",
+                            REQUEST_LABELS)
+queries_total = Counter("db_queries_total", "SQL statements issued, background jobs included")
+query_time_total = Counter("db_query_seconds_total", "Time spent in SQL statements, background jobs included")
+
+REGISTRY = [requests_in_flight, request_duration, responses, request_queries, request_db_time, queries_total,
+            query_time_total]
+# Callables returning extra exposition lines, evaluated at scrape time
+COLLECTORS: list[Callable[[], list[str]]] = []
+
+
+def gauge_family(name: str, documentation: str, label_name: str, values: dict) -> list[str]:
+    """This function renders a gauge read at scrape time, one sample per label value."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{_labels((label_name,), (label,))} {value}" for label, value in values.items()]
+    return lines
+
+
+def current_request_stats() -> RequestStats | None:
+    return _request_stats.get()
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collector in COLLECTORS:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started_at"].pop()
+    queries_total.inc()
+    query_time_total.inc(amount=elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        # Raised on the first statement over the limit so the traceback points at the query that broke it
+        if QUERY_BUDGET_MODE == "raise" and stats.budget is not None and stats.queries == stats.budget + 1:
+            raise QueryBudgetExceeded(stats.route, stats.budget)
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute, drop its start time
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started_at"):
+        connection.info["query_started_at"].pop()
+
+
+def instrument_engine(engine):
+    """This function hooks the statement counters into a sync engine (use async_engine.sync_engine for async)."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def set_query_budget_mode(mode: str):
+    """This function switches budget enforcement at runtime, e.g. from a test fixture."""
+    global QUERY_BUDGET_MODE
+    if mode not in QUERY_BUDGET_MODES:
+        raise ValueError(f"mode must be one of {', '.join(QUERY_BUDGET_MODES)}")
+    QUERY_BUDGET_MODE = mode
+
+
+def query_budget(limit: int):
+    """This function returns a route dependency declaring how many SQL statements the route may issue."""
+    async def declare_query_budget(request: Request):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.budget = limit
+            stats.route = f"{request.method} {_route_name(request.scope)}"
+    return declare_query_budget
+
+
+def _route_name(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, it does not buffer or wrap the response body so streaming is unaffected."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        started_at = time.perf_counter()
+        status = 500
+        requests_in_flight.inc()
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    elapsed_ms = (time.perf_counter() - started_at) * 1000
+                    value = (f'app;dur={elapsed_ms:.1f}, db;dur={stats.db_seconds * 1000:.1f};'
+                             f'desc="{stats.queries} queries"')
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", value.encode("latin-1")))
+                    message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            requests_in_flight.dec()
+            labels = (scope["method"], _route_name(scope))
+            request_duration.observe(time.perf_counter() - started_at, *labels)
+            responses.inc(*labels, status)
+            request_queries.observe(stats.queries, *labels)
+            request_db_time.observe(stats.db_seconds, *labels)
+            if QUERY_BUDGET_MODE == "log" and stats.budget is not None and stats.queries > stats.budget:
+                logger.warning("%s issued %s queries, its budget is %s", stats.route, stats.queries, stats.budget)
+            _request_stats.reset(token)
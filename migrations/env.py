@@ -0,0 +1,33 @@
+"""Alembic environment, migrations run against the sync engine from database.py"""
+from logging.config import fileConfig
+
+from alembic import context
+from sqlmodel import SQLModel
+
+import database
+import models  # noqa: F401 registers the tables on SQLModel.metadata
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = SQLModel.metadata
+
+
+def run_migrations_offline():
+    context.configure(url=database.DATABASE_URL, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    with database.engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,196 @@
+"""Collapse the four default shelf tables into shelf and shelf_book
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+A fresh database has nothing to migrate, init_db creates the current schema
+from models.py on startup. Every migration therefore checks what exists first.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# kind, legacy shelf table, legacy link table, legacy link column
+LEGACY_SHELVES = [
+    ("TO_READ", "to_read_shelf", "to_read_shelf_book", "to_read_shelf_id"),
+    ("DROPPED", "dropped_shelf", "dropped_shelf_book", "dropped_shelf_id"),
+    ("CURRENT", "current_shelf", "current_shelf_book", "current_shelf_id"),
+    ("READ", "read_shelf", "read_shelf_book", "read_shelf_id"),
+]
+# Same names as models.DEFAULT_SHELF_NAMES, spelled out so the migration does not change with the models
+DEFAULT_SHELF_NAMES = {"TO_READ": "Want to Read", "DROPPED": "Dropped", "CURRENT": "Currently Reading", "READ": "Read"}
+
+
+def backfill_default_shelves():
+    # Users who never had a legacy shelf row still need one shelf of each kind, get_shelf 404s without it
+    kinds = ", ".join(f"('{kind}', '{name}')" for kind, name in DEFAULT_SHELF_NAMES.items())
+    op.execute(f"""
+        INSERT INTO shelf (end_user_id, kind, shelf_name)
+        SELECT u.end_user_id, k.kind::shelf_kind, k.shelf_name
+        FROM end_user u
+        CROSS JOIN (VALUES {kinds}) AS k (kind, shelf_name)
+        ORDER BY u.end_user_id
+        ON CONFLICT (end_user_id, kind) DO NOTHING
+    """)
+
+
+def upgrade():
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+    if "end_user" not in tables:
+        return
+
+    if "shelf" not in tables:
+        op.create_table(
+            "shelf",
+            sa.Column("shelf_id", sa.Integer(), primary_key=True),
+            sa.Column("end_user_id", sa.Integer(), sa.ForeignKey("end_user.end_user_id"), nullable=False),
+            sa.Column("kind", sa.Enum("TO_READ", "DROPPED", "CURRENT", "READ", name="shelf_kind"), nullable=False),
+            sa.Column("shelf_name", sa.String(), nullable=False),
+            sa.UniqueConstraint("end_user_id", "kind", name="unique_user_shelf_kind"),
+        )
+    if "shelf_book" not in tables:
+        op.create_table(
+            "shelf_book",
+            sa.Column("bookshelf_id", sa.Integer(), primary_key=True),
+            sa.Column("shelf_id", sa.Integer(), sa.ForeignKey("shelf.shelf_id"), nullable=False),
+            sa.Column("book_id", sa.Integer(), sa.ForeignKey("book.book_id"), nullable=False),
+            sa.Column("reading_goal_id", sa.Integer(), sa.ForeignKey("reading_goal.reading_goal_id"), nullable=True),
+            sa.Column("date_added", sa.DateTime(), nullable=False),
+            sa.Column("date_read", sa.DateTime(), nullable=True),
+            sa.Column("rating", sa.Float(), nullable=True),
+            sa.Column("upcoming_book_value", sa.Integer(), nullable=True),
+            sa.UniqueConstraint("shelf_id", "book_id", name="unique_shelf_book"),
+        )
+
+    if "read_shelf_book" not in tables:
+        backfill_default_shelves()
+        return
+
+    for kind, shelf_table, link_table, link_column in LEGACY_SHELVES:
+        op.execute(f"""
+            INSERT INTO shelf (end_user_id, kind, shelf_name)
+            SELECT DISTINCT ON (end_user_id) end_user_id, '{kind}', shelf_name
+            FROM {shelf_table}
+            WHERE end_user_id IS NOT NULL
+            ORDER BY end_user_id, shelf_id
+            ON CONFLICT (end_user_id, kind) DO NOTHING
+        """)
+        # Only read_shelf_book carries dates and ratings, only to_read_shelf_book the upcoming value
+        date_read = "l.date_read" if kind == "READ" else "NULL"
+        rating = "l.rating" if kind == "READ" else "NULL"
+        reading_goal_id = "l.reading_goal_id" if kind == "READ" else "NULL"
+        upcoming_book_value = "l.upcoming_book_value" if kind == "TO_READ" else "NULL"
+        op.execute(f"""
+            INSERT INTO shelf_book (shelf_id, book_id, reading_goal_id, date_added, date_read, rating,
+                                    upcoming_book_value)
+            SELECT s.shelf_id, l.book_id, {reading_goal_id}, now(), {date_read}, {rating}, {upcoming_book_value}
+            FROM {link_table} l
+            JOIN {shelf_table} o ON o.shelf_id = l.{link_column}
+            JOIN shelf s ON s.end_user_id = o.end_user_id AND s.kind = '{kind}'
+            WHERE l.book_id IS NOT NULL
+            ORDER BY l.bookshelf_id
+            ON CONFLICT (shelf_id, book_id) DO NOTHING
+        """)
+
+    # Custom shelves pointed at read_shelf_book rows, rebuild the links against shelf_book
+    op.rename_table("custom_shelf_book_link", "custom_shelf_book_link_legacy")
+    op.execute("ALTER TABLE custom_shelf_book_link_legacy DROP CONSTRAINT IF EXISTS custom_shelf_book_link_pkey")
+    op.create_table(
+        "custom_shelf_book_link",
+        sa.Column("custom_shelf_id", sa.Integer(), sa.ForeignKey("custom_shelf.shelf_id"), primary_key=True),
+        sa.Column("bookshelf_id", sa.Integer(), sa.ForeignKey("shelf_book.bookshelf_id"), primary_key=True),
+    )
+    op.execute("""
+        INSERT INTO custom_shelf_book_link (custom_shelf_id, bookshelf_id)
+        SELECT DISTINCT c.custom_shelf_id, sb.bookshelf_id
+        FROM custom_shelf_book_link_legacy c
+        JOIN read_shelf_book r ON r.bookshelf_id = c.bookshelf_id
+        JOIN read_shelf o ON o.shelf_id = r.read_shelf_id
+        JOIN shelf s ON s.end_user_id = o.end_user_id AND s.kind = 'READ'
+        JOIN shelf_book sb ON sb.shelf_id = s.shelf_id AND sb.book_id = r.book_id
+    """)
+    op.drop_table("custom_shelf_book_link_legacy")
+
+    for _, shelf_table, link_table, _ in LEGACY_SHELVES:
+        op.drop_table(link_table)
+        op.drop_table(shelf_table)
+    backfill_default_shelves()
+
+
+def downgrade():
+    # Splits shelf and shelf_book back into the per-kind tables. Legacy rows have no date_added,
+    # a book on the Read shelf without a date_read gets its date_added instead.
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+    if "shelf" not in tables:
+        return
+
+    for kind, shelf_table, link_table, link_column in LEGACY_SHELVES:
+        op.create_table(
+            shelf_table,
+            sa.Column("shelf_id", sa.Integer(), primary_key=True),
+            sa.Column("end_user_id", sa.Integer(), sa.ForeignKey("end_user.end_user_id"), nullable=True),
+            sa.Column("shelf_name", sa.String(), nullable=False),
+        )
+        columns = [
+            sa.Column("bookshelf_id", sa.Integer(), primary_key=True),
+            sa.Column(link_column, sa.Integer(), sa.ForeignKey(f"{shelf_table}.shelf_id"),
+                      nullable=kind in ("TO_READ", "READ")),
+            sa.Column("book_id", sa.Integer(), sa.ForeignKey("book.book_id"), nullable=True),
+        ]
+        extra_columns = ""
+        if kind == "READ":
+            columns += [
+                sa.Column("reading_goal_id", sa.Integer(), sa.ForeignKey("reading_goal.reading_goal_id"), nullable=True),
+                sa.Column("date_read", sa.DateTime(), nullable=False),
+                sa.Column("rating", sa.Float(), nullable=True),
+            ]
+            extra_columns = ", reading_goal_id, date_read, rating"
+            extra_values = ", sb.reading_goal_id, coalesce(sb.date_read, sb.date_added), sb.rating"
+        elif kind == "TO_READ":
+            columns.append(sa.Column("upcoming_book_value", sa.Integer(), nullable=True))
+            extra_columns = ", upcoming_book_value"
+            extra_values = ", sb.upcoming_book_value"
+        else:
+            extra_values = ""
+        op.create_table(link_table, *columns,
+                        sa.UniqueConstraint("book_id", link_column, name=f"unique_{link_table}"))
+
+        op.execute(f"""
+            INSERT INTO {shelf_table} (end_user_id, shelf_name)
+            SELECT end_user_id, shelf_name FROM shelf WHERE kind = '{kind}' ORDER BY shelf_id
+        """)
+        op.execute(f"""
+            INSERT INTO {link_table} ({link_column}, book_id{extra_columns})
+            SELECT o.shelf_id, sb.book_id{extra_values}
+            FROM shelf_book sb
+            JOIN shelf s ON s.shelf_id = sb.shelf_id AND s.kind = '{kind}'
+            JOIN {shelf_table} o ON o.end_user_id = s.end_user_id
+            ORDER BY sb.bookshelf_id
+        """)
+
+    # Custom shelves point back at read_shelf_book rows
+    op.rename_table("custom_shelf_book_link", "custom_shelf_book_link_unified")
+    op.execute("ALTER TABLE custom_shelf_book_link_unified DROP CONSTRAINT IF EXISTS custom_shelf_book_link_pkey")
+    op.create_table(
+        "custom_shelf_book_link",
+        sa.Column("custom_shelf_id", sa.Integer(), sa.ForeignKey("custom_shelf.shelf_id"), primary_key=True),
+        sa.Column("bookshelf_id", sa.Integer(), sa.ForeignKey("read_shelf_book.bookshelf_id"), primary_key=True),
+    )
+    op.execute("""
+        INSERT INTO custom_shelf_book_link (custom_shelf_id, bookshelf_id)
+        SELECT DISTINCT c.custom_shelf_id, r.bookshelf_id
+        FROM custom_shelf_book_link_unified c
+        JOIN shelf_book sb ON sb.bookshelf_id = c.bookshelf_id
+        JOIN shelf s ON s.shelf_id = sb.shelf_id
+        JOIN read_shelf o ON o.end_user_id = s.end_user_id
+        JOIN read_shelf_book r ON r.read_shelf_id = o.shelf_id AND r.book_id = sb.book_id
+    """)
+    op.drop_table("custom_shelf_book_link_unified")
+    op.drop_table("shelf_book")
+    op.drop_table("shelf")
+    op.execute("DROP TYPE IF EXISTS shelf_kind")
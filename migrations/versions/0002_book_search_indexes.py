@@ -0,0 +1,30 @@
+"""Full-text and array indexes for book search
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if "book" not in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_book_search_document ON book "
+        "USING gin (to_tsvector('english'::regconfig, title || ' ' || description))"
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS ix_book_authors ON book USING gin (authors)")
+    op.execute("CREATE INDEX IF NOT EXISTS ix_book_categories ON book USING gin (categories)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_book_categories")
+    op.execute("DROP INDEX IF EXISTS ix_book_authors")
+    op.execute("DROP INDEX IF EXISTS ix_book_search_document")
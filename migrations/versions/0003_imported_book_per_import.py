@@ -0,0 +1,33 @@
+"""Make imported_book unique per import instead of per book
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "imported_book" not in inspector.get_table_names():
+        return
+    op.execute("ALTER TABLE imported_book DROP CONSTRAINT IF EXISTS imported_book_book_id_key")
+    op.alter_column("imported_book", "date_read", existing_type=sa.DateTime(), nullable=True)
+    if "rating" not in {column["name"] for column in inspector.get_columns("imported_book")}:
+        op.add_column("imported_book", sa.Column("rating", sa.Float(), nullable=True))
+    constraints = {constraint["name"] for constraint in inspector.get_unique_constraints("imported_book")}
+    if "unique_imported_book" not in constraints:
+        op.create_unique_constraint("unique_imported_book", "imported_book", ["transfer_history_id", "book_id"])
+
+
+def downgrade():
+    op.drop_constraint("unique_imported_book", "imported_book", type_="unique")
+    op.drop_column("imported_book", "rating")
+    op.alter_column("imported_book", "date_read", existing_type=sa.DateTime(), nullable=False)
+    op.create_unique_constraint("imported_book_book_id_key", "imported_book", ["book_id"])
@@ -0,0 +1,31 @@
+"""Index log sections by journal and date, one journal per user and book
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+    if "log_section" in tables:
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_log_section_entry_date ON log_section (journal_entry_id, original_date)"
+        )
+    if "journal_entry" in tables:
+        constraints = {constraint["name"] for constraint in inspector.get_unique_constraints("journal_entry")}
+        if "unique_user_book_journal" not in constraints:
+            op.create_unique_constraint("unique_user_book_journal", "journal_entry", ["end_user_id", "book_id"])
+
+
+def downgrade():
+    op.drop_constraint("unique_user_book_journal", "journal_entry", type_="unique")
+    op.execute("DROP INDEX IF EXISTS ix_log_section_entry_date")
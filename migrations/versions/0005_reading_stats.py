@@ -0,0 +1,33 @@
+"""Create reading_stat and backfill it from the Read shelves
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from stats import REBUILD_SQL
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+    if "shelf_book" not in tables or "reading_stat" in tables:
+        return
+    op.create_table(
+        "reading_stat",
+        sa.Column("end_user_id", sa.Integer(), sa.ForeignKey("end_user.end_user_id"), primary_key=True),
+        sa.Column("dimension", sa.String(), primary_key=True),
+        sa.Column("key", sa.String(), primary_key=True),
+        sa.Column("value", sa.Float(), nullable=False),
+    )
+    op.get_bind().execute(sa.text(REBUILD_SQL), {"owner_id": None})
+
+
+def downgrade():
+    op.drop_table("reading_stat")
@@ -0,0 +1,36 @@
+"""Give reading goals a maintained progress counter and date window
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+Existing goals start at zero and count books read from now on, their window is left open.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "reading_goal" not in inspector.get_table_names():
+        return
+    columns = {column["name"] for column in inspector.get_columns("reading_goal")}
+    if "progress" not in columns:
+        op.add_column("reading_goal", sa.Column("progress", sa.Integer(), nullable=False, server_default="0"))
+    if "start_date" not in columns:
+        op.add_column("reading_goal", sa.Column("start_date", sa.DateTime(), nullable=True))
+    if "end_date" not in columns:
+        op.add_column("reading_goal", sa.Column("end_date", sa.DateTime(), nullable=True))
+    op.execute("CREATE INDEX IF NOT EXISTS ix_reading_goal_user_active ON reading_goal (end_user_id, active)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_reading_goal_user_active")
+    op.drop_column("reading_goal", "end_date")
+    op.drop_column("reading_goal", "start_date")
+    op.drop_column("reading_goal", "progress")
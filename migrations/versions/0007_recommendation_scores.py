@@ -0,0 +1,36 @@
+"""Store ranked, scored books in recommendation
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "recommendation" not in inspector.get_table_names():
+        return
+    columns = {column["name"] for column in inspector.get_columns("recommendation")}
+    if "book_id" not in columns:
+        op.add_column("recommendation", sa.Column("book_id", sa.Integer(), sa.ForeignKey("book.book_id"), nullable=True))
+    if "score" not in columns:
+        op.add_column("recommendation", sa.Column("score", sa.Float(), nullable=False, server_default="0"))
+    if "rank" not in columns:
+        op.add_column("recommendation", sa.Column("rank", sa.Integer(), nullable=False, server_default="0"))
+    if "generated_at" not in columns:
+        op.add_column("recommendation", sa.Column("generated_at", sa.DateTime(), nullable=False,
+                                                  server_default=sa.func.now()))
+    op.execute("CREATE INDEX IF NOT EXISTS ix_recommendation_user_rank ON recommendation (end_user_id, rank)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_recommendation_user_rank")
+    for column in ("generated_at", "rank", "score", "book_id"):
+        op.drop_column("recommendation", column)
@@ -0,0 +1,25 @@
+"""Add the token version access tokens are checked against
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "end_user" not in inspector.get_table_names():
+        return
+    if "token_version" not in {column["name"] for column in inspector.get_columns("end_user")}:
+        op.add_column("end_user", sa.Column("token_version", sa.Integer(), nullable=False, server_default="0"))
+
+
+def downgrade():
+    op.drop_column("end_user", "token_version")
@@ -0,0 +1,49 @@
+"""Make custom shelf names unique per user
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18
+
+Shelves that share a name with an older shelf of the same user are merged into
+it, their books move over, before the constraint is added.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+DUPLICATES = """
+    SELECT c.shelf_id, k.shelf_id AS keep_id
+    FROM custom_shelf c
+    JOIN LATERAL (
+        SELECT min(shelf_id) AS shelf_id FROM custom_shelf
+        WHERE end_user_id = c.end_user_id AND shelf_name = c.shelf_name
+    ) k ON k.shelf_id <> c.shelf_id
+"""
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "custom_shelf" not in inspector.get_table_names():
+        return
+    constraints = {constraint["name"] for constraint in inspector.get_unique_constraints("custom_shelf")}
+    if "unique_user_custom_shelf" in constraints:
+        return
+
+    op.execute(f"""
+        INSERT INTO custom_shelf_book_link (custom_shelf_id, bookshelf_id)
+        SELECT d.keep_id, l.bookshelf_id
+        FROM custom_shelf_book_link l
+        JOIN ({DUPLICATES}) d ON d.shelf_id = l.custom_shelf_id
+        ON CONFLICT DO NOTHING
+    """)
+    op.execute(f"DELETE FROM custom_shelf_book_link WHERE custom_shelf_id IN (SELECT shelf_id FROM ({DUPLICATES}) d)")
+    op.execute(f"DELETE FROM custom_shelf WHERE shelf_id IN (SELECT shelf_id FROM ({DUPLICATES}) d)")
+    op.create_unique_constraint("unique_user_custom_shelf", "custom_shelf", ["end_user_id", "shelf_name"])
+
+
+def downgrade():
+    op.drop_constraint("unique_user_custom_shelf", "custom_shelf", type_="unique")
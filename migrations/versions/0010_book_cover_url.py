@@ -0,0 +1,25 @@
+"""Add a cover thumbnail to books for shelf previews
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "book" not in inspector.get_table_names():
+        return
+    if "cover_url" not in {column["name"] for column in inspector.get_columns("book")}:
+        op.add_column("book", sa.Column("cover_url", sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("book", "cover_url")
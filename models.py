@@ -1,4 +1,5 @@
 from typing import Optional, List
+from sqlalchemy import Index, text
 from sqlmodel import SQLModel, Field, Relationship, Column, ARRAY, String, UniqueConstraint
 from pydantic import EmailStr
 from datetime import datetime
@@ -7,6 +8,17 @@ from enum import Enum
 class Token(SQLModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
+    expires_in: int | None = None
+
+
+class RefreshRequest(SQLModel):
+    refresh_token: str
+
+
+class PasswordChange(SQLModel):
+    current_password: str
+    new_password: str
 
 
 class Image_Url(SQLModel, table=True):
@@ -39,6 +51,27 @@ class End_User(EndUserBase, table=True):
     transfer_history_id: int | None = Field(default=None, foreign_key="transfer_history.transfer_history_id")
     password_hash: str
     created_at: datetime =Field(default=datetime.now())
+    # Embedded in access tokens, bumping it invalidates every token issued before
+    token_version: int = 0
+
+
+class Refresh_Token(SQLModel, table=True):
+    refresh_token_id: int | None = Field(default=None, primary_key=True)
+    end_user_id: int = Field(foreign_key="end_user.end_user_id", index=True)
+    # Only the SHA-256 of the token is stored
+    token_hash: str = Field(unique=True)
+    # Rotations stay in the family of the login they came from, replaying a rotated token revokes the family
+    family_id: str = Field(index=True)
+    created_at: datetime = Field(default_factory=datetime.now)
+    expires_at: datetime
+    used_at: datetime | None = None
+    revoked_at: datetime | None = None
+
+
+class Revoked_Token(SQLModel, table=True):
+    jti: str = Field(primary_key=True)
+    # Once the access token has expired the entry is no longer needed
+    expires_at: datetime = Field(index=True)
 
 
 class EndUserCreate(EndUserBase):
@@ -62,12 +95,19 @@ class Reading_Goal(SQLModel, table=True):
     title: str
     target: int
     active: bool = False
+    # Books read inside the window, maintained by the Read shelf writes
+    progress: int = 0
+    start_date: datetime | None = None
+    end_date: datetime | None = None
+    __table_args__ = (Index("ix_reading_goal_user_active", "end_user_id", "active"),)
 
 class ReadingGoalCreate(SQLModel):
     title: str
     target: int
-    progress: Optional[int] = 0
     active: Optional[bool] = True
+    # Defaults to now, a window starting in the past counts the books already read in it
+    start_date: datetime | None = None
+    end_date: datetime | None = None
 
 class ReadingGoalUpdate(SQLModel):
     title: Optional[str] = None
@@ -81,9 +121,51 @@ class ReadingGoalRead(Reading_Goal):
     class Config:
         from_attributes = True
 
+class Collection_Version(SQLModel, table=True):
+    end_user_id: int = Field(foreign_key="end_user.end_user_id", primary_key=True)
+    collection: str = Field(primary_key=True)
+    version: int = 0
+
+
+class Reading_Stat(SQLModel, table=True):
+    # One counter per (dimension, key), e.g. ("total", "books"), ("year", "2024"), ("author", "Ursula K. Le Guin")
+    end_user_id: int = Field(foreign_key="end_user.end_user_id", primary_key=True)
+    dimension: str = Field(primary_key=True)
+    key: str = Field(primary_key=True)
+    value: float = 0
+
+
+class StatCount(SQLModel):
+    name: str
+    count: int
+
+
+class ReadingStats(SQLModel):
+    books_read: int = 0
+    pages_read: int = 0
+    average_rating: float | None = None
+    books_per_year: dict[str, int] = {}
+    books_per_month: dict[str, int] = {}
+    top_categories: List[StatCount] = []
+    top_authors: List[StatCount] = []
+
+
 class Recommendation(SQLModel, table=True):
     recommendation_id: int | None = Field(default=None, primary_key=True)
     end_user_id: int | None = Field(default=None, foreign_key="end_user.end_user_id")
+    book_id: int | None = Field(default=None, foreign_key="book.book_id")
+    score: float = 0
+    rank: int = 0
+    generated_at: datetime = Field(default_factory=datetime.now)
+    # A user's list is read in rank order, the index serves it without a sort
+    __table_args__ = (Index("ix_recommendation_user_rank", "end_user_id", "rank"),)
+
+
+class Recommendation_Run(SQLModel, table=True):
+    recommendation_run_id: int | None = Field(default=None, primary_key=True)
+    started_at: datetime = Field(default_factory=datetime.now)
+    finished_at: datetime | None = None
+    users_updated: int = 0
 
 
 class CustomShelfBase(SQLModel):
@@ -92,13 +174,15 @@ class CustomShelfBase(SQLModel):
 
 class Custom_Shelf_Book_Link(SQLModel, table=True):
     custom_shelf_id: Optional[int] = Field(default=None, foreign_key="custom_shelf.shelf_id", primary_key=True)
-    bookshelf_id: Optional[int] = Field(default=None, foreign_key="read_shelf_book.bookshelf_id", primary_key=True)
+    bookshelf_id: Optional[int] = Field(default=None, foreign_key="shelf_book.bookshelf_id", primary_key=True)
 
 
 class Custom_Shelf(CustomShelfBase, table=True):
     shelf_id: Optional[int] = Field(default=None, primary_key=True)
     end_user_id: Optional[int] = Field(default=None, foreign_key="end_user.end_user_id")
-    shelf_books: List["Read_Shelf_Book"] = Relationship(back_populates="custom_shelves", link_model=Custom_Shelf_Book_Link)
+    shelf_books: List["Shelf_Book"] = Relationship(back_populates="custom_shelves", link_model=Custom_Shelf_Book_Link)
+    # Shelves are addressed by name in the API, the unique index makes that lookup a single probe
+    __table_args__ = (UniqueConstraint("end_user_id", "shelf_name", name="unique_user_custom_shelf"),)
 
 
 class CustomShelfCreate(CustomShelfBase):
@@ -109,28 +193,48 @@ class CustomShelfUpdate(CustomShelfBase):
     shelf_name: Optional[str] = None
 
 
-class To_Read_Shelf(SQLModel, table=True):
-    shelf_id: int | None = Field(default=None, primary_key=True)
-    end_user_id: int | None = Field(default=None, foreign_key="end_user.end_user_id")
-    shelf_name: str = Field(default="Want to Read")
+class CustomShelfBook(SQLModel):
+    book_id: int
+    google_book_id: str
+    title: str
+    authors: List[str] | None = None
+    cover_url: str | None = None
 
 
-class Dropped_Shelf(SQLModel, table=True):
-    shelf_id: int | None = Field(default=None, primary_key=True)
-    end_user_id: int | None = Field(default=None, foreign_key="end_user.end_user_id")
-    shelf_name: str = Field(default="Dropped")
+class CustomShelfRead(CustomShelfBase):
+    shelf_id: int
+    end_user_id: int
+    # Only filled in when asked for with ?include=counts,preview
+    book_count: int | None = None
+    preview: List[CustomShelfBook] | None = None
 
 
-class Current_Shelf(SQLModel, table=True):
-    shelf_id: int | None = Field(default=None, primary_key=True)
-    end_user_id: int | None = Field(default=None, foreign_key="end_user.end_user_id")
-    shelf_name: str = Field(default="Currently Reading")
+class Shelf_Kind(Enum):
+    TO_READ = 'to_read'
+    DROPPED = 'dropped'
+    CURRENT = 'current'
+    READ = 'read'
+
 
+DEFAULT_SHELF_NAMES = {
+    Shelf_Kind.TO_READ: "Want to Read",
+    Shelf_Kind.DROPPED: "Dropped",
+    Shelf_Kind.CURRENT: "Currently Reading",
+    Shelf_Kind.READ: "Read",
+}
 
-class Read_Shelf(SQLModel, table=True):
+
+class Shelf(SQLModel, table=True):
     shelf_id: int | None = Field(default=None, primary_key=True)
-    end_user_id: int | None = Field(default=None, foreign_key="end_user.end_user_id")
-    shelf_name: str = Field(default="Read")
+    end_user_id: int = Field(foreign_key="end_user.end_user_id")
+    kind: Shelf_Kind
+    shelf_name: str
+    # Every user has exactly one shelf of each kind, the unique index makes resolving it a single probe
+    __table_args__ = (UniqueConstraint("end_user_id", "kind", name="unique_user_shelf_kind"),)
+
+
+# Search queries must spell the expression exactly like the index so the planner can use it
+BOOK_SEARCH_DOCUMENT = "to_tsvector('english'::regconfig, book.title || ' ' || book.description)"
 
 
 class Book(SQLModel, table=True):
@@ -142,58 +246,129 @@ class Book(SQLModel, table=True):
     number_of_pages: int
     categories: List[str] | None = Field(sa_column=Column(ARRAY(String)), default_factory=list)
     published_date: str | None
+    # Cover thumbnail from the book source, Image_Url only holds profile pictures
+    cover_url: str | None = None
     # date_read: datetime
     # rating: float | None
+    __table_args__ = (
+        Index("ix_book_search_document", text(BOOK_SEARCH_DOCUMENT.replace("book.", "")), postgresql_using="gin"),
+        Index("ix_book_authors", "authors", postgresql_using="gin"),
+        Index("ix_book_categories", "categories", postgresql_using="gin"),
+    )
+
+
+# Book columns a listing can project with ?fields=, the summary is what it sends by default
+BOOK_LIST_FIELDS = ("book_id", "google_book_id", "title", "authors", "number_of_pages", "cover_url", "categories",
+                    "published_date", "description")
+BOOK_SUMMARY_FIELDS = ("book_id", "google_book_id", "title", "authors", "number_of_pages", "cover_url")
+
+
+class BookListItem(SQLModel):
+    # Every field is optional, listings are sent with exclude_unset so only the projected ones appear
+    book_id: int | None = None
+    google_book_id: str | None = None
+    title: str | None = None
+    authors: List[str] | None = None
+    number_of_pages: int | None = None
+    cover_url: str | None = None
+    categories: List[str] | None = None
+    published_date: str | None = None
+    description: str | None = None
+
+
+class BookPage(SQLModel):
+    items: List[BookListItem]
+    next_cursor: str | None = None
 
 
-class Read_Shelf_Book(SQLModel, table=True):
+class RecommendationRead(SQLModel):
+    rank: int
+    score: float
+    generated_at: datetime
+    book: Book
+
+
+class BookBatchResult(SQLModel):
+    google_book_id: str
+    book_id: int
+    status: str
+
+
+class Shelf_Book(SQLModel, table=True):
     bookshelf_id: int | None = Field(default=None, primary_key=True)
-    read_shelf_id: int | None = Field(default=None, foreign_key="read_shelf.shelf_id")
+    shelf_id: int = Field(foreign_key="shelf.shelf_id")
     custom_shelves: List["Custom_Shelf"] = Relationship(
         back_populates="shelf_books",
         link_model=Custom_Shelf_Book_Link
     )
-    book_id: int | None = Field(default=None, foreign_key="book.book_id")
+    book_id: int = Field(foreign_key="book.book_id")
     reading_goal_id: int | None = Field(default=None, foreign_key="reading_goal.reading_goal_id")
-    date_read: datetime
-    rating: float | None
-    __table_args__ = (UniqueConstraint("book_id", "read_shelf_id", name="unique_read_shelf_book"),)
+    date_added: datetime = Field(default_factory=datetime.now)
+    date_read: datetime | None = None
+    rating: float | None = None
+    upcoming_book_value: int | None = None
+    __table_args__ = (UniqueConstraint("shelf_id", "book_id", name="unique_shelf_book"),)
 
-class To_Read_Shelf_Book(SQLModel, table=True):
-    bookshelf_id: int | None = Field(default=None, primary_key=True)
-    to_read_shelf_id: int | None = Field(default=None, foreign_key="to_read_shelf.shelf_id")
+
+class Imported_Book(SQLModel, table=True):
+    imported_book_id: int | None = Field(default=None, primary_key=True)
     book_id: int | None = Field(default=None, foreign_key="book.book_id")
-    upcoming_book_value: int | None
-    __table_args__ = (UniqueConstraint("book_id", "to_read_shelf_id", name="unique_to_read_shelf_book"),)
+    transfer_history_id: int | None = Field(default=None, foreign_key="transfer_history.transfer_history_id")
+    review: str = ""
+    date_read: datetime | None = None
+    rating: float | None = None
+    original_shelf: str
+    # A book shows up once per import, but many users import the same book
+    __table_args__ = (UniqueConstraint("transfer_history_id", "book_id", name="unique_imported_book"),)
 
 
-class Dropped_Shelf_Book(SQLModel, table=True):
-    bookshelf_id: int | None = Field(default=None, primary_key=True)
-    dropped_shelf_id: int = Field(default=None, foreign_key="dropped_shelf.shelf_id")
-    book_id: int | None = Field(default=None, foreign_key="book.book_id")
-    __table_args__ = (UniqueConstraint("book_id", "dropped_shelf_id", name="unique_dropped_shelf_book"),)
+class Import_Status(Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
 
 
-class Current_Shelf_Book(SQLModel, table=True):
-    bookshelf_id: int | None = Field(default=None, primary_key=True)
-    current_shelf_id: int = Field(default=None, foreign_key="current_shelf.shelf_id")
-    book_id: int | None = Field(default=None, foreign_key="book.book_id")
-    __table_args__ = (UniqueConstraint("book_id", "current_shelf_id", name="unique_current_shelf_book"),)
+class ImportJobBase(SQLModel):
+    source: str
+    status: Import_Status = Import_Status.PENDING
+    rows_total: int | None = None
+    # Rows committed so far, a resumed job starts reading after this row
+    rows_read: int = 0
+    books_imported: int = 0
+    duplicates_skipped: int = 0
+    error: str | None = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
 
 
-class Imported_Book(SQLModel, table=True):
-    imported_book_id: int | None = Field(default=None, primary_key=True)
-    book_id: int | None = Field(default=None, foreign_key="book.book_id", unique=True)
-    transfer_history_id: int | None = Field(default=None, foreign_key="transfer_history.transfer_history_id")
-    review: str
-    date_read: datetime
-    original_shelf: str
+class Import_Job(ImportJobBase, table=True):
+    import_job_id: int | None = Field(default=None, primary_key=True)
+    end_user_id: int = Field(foreign_key="end_user.end_user_id", index=True)
+    transfer_history_id: int = Field(foreign_key="transfer_history.transfer_history_id")
+    file_path: str
+
+
+class ImportJobRead(ImportJobBase):
+    import_job_id: int
+    transfer_history_id: int
 
 
 class Journal_Entry(SQLModel, table=True):
     journal_entry_id: int | None = Field(default=None, primary_key=True)
     book_id: int | None = Field(default=None, foreign_key="book.book_id")
     end_user_id: int | None = Field(default=None, foreign_key="end_user.end_user_id")
+    __table_args__ = (UniqueConstraint("end_user_id", "book_id", name="unique_user_book_journal"),)
+
+
+class JournalEntryCreate(SQLModel):
+    book_id: int
+
+
+class JournalEntryRead(SQLModel):
+    journal_entry_id: int
+    book_id: int
+    end_user_id: int
 
 
 class Log_Section(SQLModel, table=True):
@@ -201,5 +376,36 @@ class Log_Section(SQLModel, table=True):
     journal_entry_id: int | None = Field(default=None, foreign_key="journal_entry.journal_entry_id")
     section_name: str
     entry_text: str
+    original_date: datetime = Field(default_factory=datetime.now)
+    edited_date: datetime = Field(default_factory=datetime.now)
+    __table_args__ = (Index("ix_log_section_entry_date", "journal_entry_id", "original_date"),)
+
+
+class LogSectionCreate(SQLModel):
+    section_name: str
+    entry_text: str = ""
+
+
+class LogSectionUpdate(SQLModel):
+    section_name: Optional[str] = None
+    # Either replace the text or append to it, appending never resends what is already stored
+    entry_text: Optional[str] = None
+    append_text: Optional[str] = None
+
+
+class LogSectionSummary(SQLModel):
+    log_section_id: int
+    journal_entry_id: int
+    section_name: str
     original_date: datetime
-    edited_date: datetime
\ No newline at end of file
+    edited_date: datetime
+    text_length: int
+
+
+class LogSectionRead(LogSectionSummary):
+    entry_text: str
+
+
+class LogSectionPage(SQLModel):
+    items: List[LogSectionSummary]
+    next_cursor: str | None = None
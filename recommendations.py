@@ -0,0 +1,224 @@
+"""This module contains the offline recommendation job
+
+    python recommendations.py [--full]
+
+Read shelves become a sparse user x book matrix (the rating, or IMPLICIT_RATING
+for a book read without one). A book's score blends item-item cosine similarity
+over that matrix with author / category overlap. Both are computed for a batch
+of users at a time as sparse products and the top books are picked from the
+non-zero scores of each row, so neither the book x book similarity matrix nor a
+dense users x books score array is ever materialised. Unless --full is given
+only users whose shelves changed since the last finished run are recomputed,
+and batches are spread over worker processes.
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from dotenv import load_dotenv
+from scipy import sparse
+from sqlalchemy import delete, func, insert
+from sqlmodel import Session, select
+
+import database
+from models import Book, Recommendation, Recommendation_Run, Shelf, Shelf_Book, Shelf_Kind
+
+load_dotenv()
+
+RECOMMENDATION_TOP_N = int(os.getenv("RECOMMENDATION_TOP_N", "20"))
+RECOMMENDATION_WORKERS = int(os.getenv("RECOMMENDATION_WORKERS", str(os.cpu_count() or 1)))
+RECOMMENDATION_BATCH_USERS = int(os.getenv("RECOMMENDATION_BATCH_USERS", "256"))
+RECOMMENDATION_CONTENT_WEIGHT = float(os.getenv("RECOMMENDATION_CONTENT_WEIGHT", "0.3"))
+IMPLICIT_RATING = 3.0
+YIELD_PER = 10000
+
+logger = logging.getLogger(__name__)
+
+# Set once per worker process by _init_worker
+_model = None
+
+
+class Model(NamedTuple):
+    ratings: sparse.csr_matrix
+    item_vectors: sparse.csr_matrix
+    features: sparse.csr_matrix
+    shelved: sparse.csr_matrix
+    user_ids: np.ndarray
+    book_ids: np.ndarray
+
+
+def _stream(db: Session, statement):
+    return db.exec(statement.execution_options(stream_results=True, yield_per=YIELD_PER))
+
+
+def _normalize_columns(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    return (matrix @ sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0))).tocsr()
+
+
+def load_model(db: Session) -> Model:
+    """This function reads every shelf once and builds the sparse matrices the scores are computed from."""
+    user_index, book_index = {}, {}
+    read_users, read_books, read_values = [], [], []
+    shelved_users, shelved_books = [], []
+    statement = (
+        select(Shelf.end_user_id, Shelf.kind, Shelf_Book.book_id, Shelf_Book.rating)
+        .join(Shelf, Shelf.shelf_id == Shelf_Book.shelf_id)
+    )
+    for row in _stream(db, statement):
+        user = user_index.setdefault(row.end_user_id, len(user_index))
+        book = book_index.setdefault(row.book_id, len(book_index))
+        # Any shelf, read or not, keeps the book out of that user's recommendations
+        shelved_users.append(user)
+        shelved_books.append(book)
+        if row.kind == Shelf_Kind.READ:
+            read_users.append(user)
+            read_books.append(book)
+            read_values.append(row.rating or IMPLICIT_RATING)
+
+    feature_index = {}
+    feature_books, feature_columns = [], []
+    books = select(Book.book_id, Book.authors, Book.categories).where(
+        Book.book_id.in_(select(Shelf_Book.book_id).distinct())
+    )
+    for row in _stream(db, books):
+        book = book_index.get(row.book_id)
+        if book is None:
+            continue
+        features = [f"author:{author}" for author in row.authors or ()]
+        features += [f"category:{category}" for category in row.categories or ()]
+        for feature in set(features):
+            feature_books.append(book)
+            feature_columns.append(feature_index.setdefault(feature, len(feature_index)))
+
+    shape = (len(user_index), len(book_index))
+    ratings = sparse.csr_matrix((np.asarray(read_values, dtype=np.float32), (read_users, read_books)), shape=shape)
+    shelved = sparse.csr_matrix((np.ones(len(shelved_users), dtype=np.float32), (shelved_users, shelved_books)),
+                                shape=shape)
+    features = sparse.csr_matrix(
+        (np.ones(len(feature_books), dtype=np.float32), (feature_books, feature_columns)),
+        shape=(len(book_index), len(feature_index)),
+    )
+    return Model(
+        ratings=ratings,
+        item_vectors=_normalize_columns(ratings),
+        # Normalising the transposed columns normalises each book's feature row
+        features=_normalize_columns(features.T.tocsr()).T.tocsr(),
+        shelved=shelved,
+        user_ids=np.fromiter(user_index.keys(), dtype=np.int64, count=len(user_index)),
+        book_ids=np.fromiter(book_index.keys(), dtype=np.int64, count=len(book_index)),
+    )
+
+
+def _init_worker(model: Model):
+    global _model
+    _model = model
+
+
+def score_batch(rows: list[int]) -> list[tuple[int, list[tuple[int, float]]]]:
+    """This function returns the top books for a batch of matrix rows as (end_user_id, [(book_id, score)])."""
+    model = _model
+    read = model.ratings[rows]
+    # read @ (V.T @ V) without forming the book x book matrix: (read @ V.T) is batch x users
+    collaborative = (read @ model.item_vectors.T) @ model.item_vectors
+    content = (read @ model.features) @ model.features.T
+    # Kept sparse, a dense batch x books array would grow with the catalogue
+    scores = ((1 - RECOMMENDATION_CONTENT_WEIGHT) * collaborative + RECOMMENDATION_CONTENT_WEIGHT * content).tocsr()
+    shelved = model.shelved[rows]
+
+    results = []
+    for position, row in enumerate(rows):
+        start, end = scores.indptr[position], scores.indptr[position + 1]
+        columns, values = scores.indices[start:end], scores.data[start:end]
+        shelved_columns = shelved.indices[shelved.indptr[position]:shelved.indptr[position + 1]]
+        keep = (values > 0) & ~np.isin(columns, shelved_columns)
+        columns, values = columns[keep], values[keep]
+        if 0 < RECOMMENDATION_TOP_N < len(values):
+            top = np.argpartition(-values, RECOMMENDATION_TOP_N - 1)[:RECOMMENDATION_TOP_N]
+            columns, values = columns[top], values[top]
+        columns, values = columns[:RECOMMENDATION_TOP_N], values[:RECOMMENDATION_TOP_N]
+        order = np.argsort(-values)
+        results.append((
+            int(model.user_ids[row]),
+            [(int(model.book_ids[column]), float(value)) for column, value in zip(columns[order], values[order])],
+        ))
+    return results
+
+
+def changed_users(db: Session, since: datetime) -> set[int]:
+    statement = (
+        select(Shelf.end_user_id).distinct()
+        .join(Shelf_Book, Shelf_Book.shelf_id == Shelf.shelf_id)
+        .where(Shelf_Book.date_added > since)
+    )
+    return set(db.exec(statement).all())
+
+
+def write_batch(db: Session, results: list, generated_at: datetime):
+    """This function replaces the stored recommendations of a batch of users in one transaction."""
+    db.execute(delete(Recommendation).where(Recommendation.end_user_id.in_([user_id for user_id, _ in results])))
+    rows = [
+        {"end_user_id": user_id, "book_id": book_id, "score": score, "rank": rank, "generated_at": generated_at}
+        for user_id, items in results
+        for rank, (book_id, score) in enumerate(items, start=1)
+    ]
+    if rows:
+        db.execute(insert(Recommendation), rows)
+    db.commit()
+
+
+def run(full: bool = False) -> int:
+    """This function recomputes recommendations and returns how many users were updated."""
+    with Session(database.engine) as db:
+        since = None
+        if not full:
+            since = db.exec(
+                select(func.max(Recommendation_Run.started_at)).where(Recommendation_Run.finished_at.is_not(None))
+            ).one()
+        # Activity while the job runs is newer than started_at, the next run picks it up
+        job = Recommendation_Run()
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+
+        model = load_model(db)
+        rows = range(len(model.user_ids))
+        if since is not None:
+            changed = changed_users(db, since)
+            rows = [row for row, user_id in enumerate(model.user_ids) if int(user_id) in changed]
+        # Users who have not read anything have nothing to compare with
+        read_counts = np.diff(model.ratings.indptr)
+        rows = [row for row in rows if read_counts[row]]
+        batches = [rows[start:start + RECOMMENDATION_BATCH_USERS]
+                   for start in range(0, len(rows), RECOMMENDATION_BATCH_USERS)]
+        logger.info("Recommending for %s users in %s batches", len(rows), len(batches))
+
+        updated = 0
+        if batches:
+            with ProcessPoolExecutor(max_workers=RECOMMENDATION_WORKERS, initializer=_init_worker,
+                                     initargs=(model,)) as pool:
+                for results in pool.map(score_batch, batches):
+                    write_batch(db, results, job.started_at)
+                    updated += len(results)
+
+        job.finished_at = datetime.now()
+        job.users_updated = updated
+        db.add(job)
+        db.commit()
+        return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute book recommendations")
+    parser.add_argument("--full", action="store_true", help="Recompute every user, not only recent activity")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    run(args.full)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""This module contains the response compression middleware
+
+Responses are compressed with the best encoding the client accepts out of
+COMPRESSION_ENCODINGS. gzip is always available, br and zstd only when the
+brotli and zstandard packages are installed. Bodies under COMPRESSION_MIN_SIZE
+(/, /users/me, 204s and 304s) go out as they are, the framing would cost more
+than it saves. Only text-like content types are compressed, anything already
+encoded or binary (application/gzip, images, zips) is passed through.
+"""
+import os
+import zlib
+
+from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv()
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Server preference, used to break ties between encodings the client rates the same
+COMPRESSION_ENCODINGS = [
+    encoding.strip().lower() for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")
+    if encoding.strip()
+]
+if set(COMPRESSION_ENCODINGS) - {"gzip", "br", "zstd"}:
+    raise RuntimeError("COMPRESSION_ENCODINGS must only list gzip, br and zstd")
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/x-ndjson", "application/javascript", "application/xml",
+    "application/problem+json", "image/svg+xml",
+}
+UNCOMPRESSED_STATUSES = {204, 304}
+
+
+class GzipCompressor:
+    def __init__(self):
+        # wbits 31 writes the gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+COMPRESSORS = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    """This function picks the encoding to use from an Accept-Encoding header, None if nothing fits."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.partition(";")
+        weight = 1.0
+        parameter, _, value = parameters.strip().partition("=")
+        if parameter.strip().lower() == "q":
+            try:
+                weight = float(value)
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in COMPRESSION_ENCODINGS:
+        if encoding not in COMPRESSORS:
+            continue
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def is_compressible(status: int, headers: Headers) -> bool:
+    if status in UNCOMPRESSED_STATUSES or "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    if content_type == "text/event-stream":
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware, a streamed body is compressed chunk by chunk instead of being buffered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether the response is worth compressing
+                start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                if start_message is not None:
+                    await send(start_message)
+                    start_message = None
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is None:
+                data = compressor.compress(body)
+                if not more_body:
+                    data += compressor.finish()
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+                return
+
+            raw_headers = start_message["headers"] = list(start_message.get("headers", []))
+            headers = MutableHeaders(raw=raw_headers)
+            if not is_compressible(start_message["status"], headers):
+                passthrough = True
+            else:
+                headers.add_vary_header("Accept-Encoding")
+                passthrough = not more_body and len(body) < COMPRESSION_MIN_SIZE
+            if passthrough:
+                await send(start_message)
+                start_message = None
+                await send(message)
+                return
+
+            compressor = COMPRESSORS[encoding]()
+            headers["Content-Encoding"] = encoding
+            data = compressor.compress(body)
+            if more_body:
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+            else:
+                data += compressor.finish()
+                headers["Content-Length"] = str(len(data))
+            await send(start_message)
+            start_message = None
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+        # A response that ended without a body message still has to start
+        if start_message is not None:
+            await send(start_message)
@@ -1,16 +1,45 @@
 """This module contains code to ensure security in app"""
 
+import asyncio
+import multiprocessing
 import os
-from datetime import datetime, timedelta, timezone
-from jose import JWTError, jwt
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 import bcrypt
 from dotenv import load_dotenv
+from fastapi import HTTPException
+
+import metrics
 
 load_dotenv()
 
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))
+
+_password_pool: ProcessPoolExecutor | None = None
+_password_pool_lock = threading.Lock()
+_password_pool_stats = {
+    "pending": 0,
+    "completed": 0,
+    "rejected": 0,
+    "queue_wait_seconds": 0.0,
+    "hash_seconds": 0.0,
+}
+
+PASSWORD_JOB_LABELS = ("operation",)
+password_queue_wait = metrics.Histogram("password_job_queue_wait_seconds",
+                                        "Time a password job waited for a free worker", PASSWORD_JOB_LABELS)
+password_job_time = metrics.Histogram("password_job_seconds", "Time a worker spent hashing or verifying a password",
+                                      PASSWORD_JOB_LABELS)
+password_jobs_rejected = metrics.Counter("password_jobs_rejected_total",
+                                         "Password jobs turned away with a 503 because the queue was full")
+password_jobs_rejected.inc(amount=0)
+metrics.REGISTRY += [password_queue_wait, password_job_time, password_jobs_rejected]
+# Label values per pooled function
+PASSWORD_OPERATIONS = {"verify_password": "verify", "get_password_hash": "hash"}
+
 
 def verify_password(plain: str, hashed: str) -> bool:
     """This function uses bcrypt library to verify password against the hashed password."""
@@ -19,21 +48,83 @@ def verify_password(plain: str, hashed: str) -> bool:
 
 def get_password_hash(password: str) -> str:
     """This function uses bcrypt library to generate hashed password."""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(BCRYPT_ROUNDS)).decode("utf-8")
+
+
+def needs_rehash(hashed: str) -> bool:
+    """This function checks whether a bcrypt hash was made with a different cost factor than configured."""
+    # bcrypt hashes look like $2b$<rounds>$<salt and digest>
+    return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+
+
+def _timed_call(func, submitted_at: float, *args):
+    """This function runs inside a pool worker and reports how long the job queued and ran."""
+    started_at = time.time()
+    result = func(*args)
+    return result, started_at - submitted_at, time.time() - started_at
+
 
+def _get_password_pool() -> ProcessPoolExecutor:
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            # Forking the server, which already runs threads and holds engine locks, can deadlock the children
+            _password_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return _password_pool
 
-def create_access_token(subject: str) -> str:
-    """This function JWT to create access token."""
-    expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode = {"exp": expire, "sub": subject}
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def start_password_pool():
+    """This function starts the password worker processes, so the first login does not wait for them."""
+    pool = _get_password_pool()
+    for _ in range(PASSWORD_HASH_WORKERS):
+        pool.submit(os.getpid)
 
-def decode_access_token(token: str) -> str | None:
-    """This function JWT to decode access token."""
+
+def shutdown_password_pool():
+    """This function stops the password worker processes."""
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is not None:
+            _password_pool.shutdown(cancel_futures=True)
+            _password_pool = None
+
+
+async def _run_in_password_pool(func, *args):
+    with _password_pool_lock:
+        if _password_pool_stats["pending"] >= PASSWORD_HASH_MAX_PENDING:
+            _password_pool_stats["rejected"] += 1
+            password_jobs_rejected.inc()
+            raise HTTPException(status_code=503, detail="Server is busy, try again shortly",
+                                headers={"Retry-After": "1"})
+        _password_pool_stats["pending"] += 1
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
-    except JWTError:
-        print("There seems to be an error")
-        return None
+        future = _get_password_pool().submit(_timed_call, func, time.time(), *args)
+        result, queue_wait, hash_time = await asyncio.wrap_future(future)
+    finally:
+        with _password_pool_lock:
+            _password_pool_stats["pending"] -= 1
+    with _password_pool_lock:
+        _password_pool_stats["completed"] += 1
+        _password_pool_stats["queue_wait_seconds"] += queue_wait
+        _password_pool_stats["hash_seconds"] += hash_time
+    operation = PASSWORD_OPERATIONS.get(func.__name__, func.__name__)
+    password_queue_wait.observe(queue_wait, operation)
+    password_job_time.observe(hash_time, operation)
+    return result
+
+
+async def verify_password_async(plain: str, hashed: str) -> bool:
+    """This function verifies a password in the password worker pool."""
+    return await _run_in_password_pool(verify_password, plain, hashed)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """This function hashes a password in the password worker pool."""
+    return await _run_in_password_pool(get_password_hash, password)
+
+
+def password_pool_stats() -> dict:
+    """This function returns a snapshot of the password worker pool counters."""
+    with _password_pool_lock:
+        return dict(_password_pool_stats, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING)
@@ -0,0 +1,136 @@
+"""This module contains the precomputed reading statistics
+
+Every book that lands on a Read shelf adds to a handful of per-user counters
+(totals, books per year and month, categories, authors) in the same transaction
+as the shelf write, so the dashboard reads counters instead of aggregating the
+whole reading history. The counters can always be rebuilt from the shelves:
+
+    python stats.py rebuild [--user END_USER_ID]
+"""
+import argparse
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, NamedTuple
+
+from sqlalchemy import delete, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session
+
+import database
+from models import Reading_Stat, ReadingStats, StatCount
+
+TOP_COUNT = 10
+
+REBUILD_SQL = """
+    WITH read_books AS (
+        SELECT s.end_user_id, b.number_of_pages, b.authors, b.categories, sb.rating,
+               coalesce(sb.date_read, sb.date_added) AS finished
+        FROM shelf_book sb
+        JOIN shelf s ON s.shelf_id = sb.shelf_id
+        JOIN book b ON b.book_id = sb.book_id
+        WHERE s.kind = 'READ' AND (CAST(:owner_id AS integer) IS NULL OR s.end_user_id = :owner_id)
+    )
+    INSERT INTO reading_stat (end_user_id, dimension, key, value)
+    SELECT end_user_id, 'total', 'books', count(*) FROM read_books GROUP BY end_user_id
+    UNION ALL
+    SELECT end_user_id, 'total', 'pages', coalesce(sum(number_of_pages), 0) FROM read_books GROUP BY end_user_id
+    UNION ALL
+    SELECT end_user_id, 'total', 'rating_sum', coalesce(sum(rating), 0) FROM read_books GROUP BY end_user_id
+    UNION ALL
+    SELECT end_user_id, 'total', 'rating_count', count(rating) FROM read_books GROUP BY end_user_id
+    UNION ALL
+    SELECT end_user_id, 'year', to_char(finished, 'YYYY'), count(*) FROM read_books GROUP BY 1, 3
+    UNION ALL
+    SELECT end_user_id, 'month', to_char(finished, 'YYYY-MM'), count(*) FROM read_books GROUP BY 1, 3
+    UNION ALL
+    SELECT end_user_id, 'category', category, count(*) FROM read_books, unnest(categories) AS category GROUP BY 1, 3
+    UNION ALL
+    SELECT end_user_id, 'author', author, count(*) FROM read_books, unnest(authors) AS author GROUP BY 1, 3
+"""
+
+
+class ReadBook(NamedTuple):
+    number_of_pages: int | None
+    authors: list | None
+    categories: list | None
+    date_read: datetime | None
+    rating: float | None
+
+
+def read_book_counters(books: Iterable[ReadBook]) -> Counter:
+    """This function turns newly read books into counter increments keyed by (dimension, key)."""
+    counters = Counter()
+    for book in books:
+        finished = book.date_read or datetime.now()
+        counters["total", "books"] += 1
+        counters["total", "pages"] += book.number_of_pages or 0
+        if book.rating is not None:
+            counters["total", "rating_sum"] += book.rating
+            counters["total", "rating_count"] += 1
+        counters["year", finished.strftime("%Y")] += 1
+        counters["month", finished.strftime("%Y-%m")] += 1
+        for category in book.categories or ():
+            counters["category", category] += 1
+        for author in book.authors or ():
+            counters["author", author] += 1
+    return counters
+
+
+def counters_upsert(owner_id: int, counters: Counter):
+    """This function builds one statement adding the increments to the stored counters."""
+    statement = pg_insert(Reading_Stat).values([
+        {"end_user_id": owner_id, "dimension": dimension, "key": key, "value": value}
+        for (dimension, key), value in counters.items()
+    ])
+    return statement.on_conflict_do_update(
+        index_elements=["end_user_id", "dimension", "key"],
+        set_={"value": Reading_Stat.value + statement.excluded.value},
+    )
+
+
+def _top(counts: dict[str, float]) -> list[StatCount]:
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:TOP_COUNT]
+    return [StatCount(name=name, count=int(count)) for name, count in ranked]
+
+
+def stats_from_rows(rows: Iterable[Reading_Stat]) -> ReadingStats:
+    """This function shapes a user's counter rows into the dashboard response."""
+    dimensions = {}
+    for row in rows:
+        dimensions.setdefault(row.dimension, {})[row.key] = row.value
+    totals = dimensions.get("total", {})
+    rating_count = totals.get("rating_count", 0)
+    return ReadingStats(
+        books_read=int(totals.get("books", 0)),
+        pages_read=int(totals.get("pages", 0)),
+        average_rating=round(totals["rating_sum"] / rating_count, 2) if rating_count else None,
+        books_per_year={key: int(value) for key, value in sorted(dimensions.get("year", {}).items())},
+        books_per_month={key: int(value) for key, value in sorted(dimensions.get("month", {}).items())},
+        top_categories=_top(dimensions.get("category", {})),
+        top_authors=_top(dimensions.get("author", {})),
+    )
+
+
+def rebuild(owner_id: int | None = None):
+    """This function recomputes the counters of one user, or of everyone, from the Read shelves."""
+    with Session(database.engine) as db:
+        statement = delete(Reading_Stat)
+        if owner_id is not None:
+            statement = statement.where(Reading_Stat.end_user_id == owner_id)
+        db.execute(statement)
+        db.execute(text(REBUILD_SQL), {"owner_id": owner_id})
+        db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the precomputed reading statistics")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_command = commands.add_parser("rebuild", help="Recompute the counters from the Read shelves")
+    rebuild_command.add_argument("--user", type=int, default=None, help="Only rebuild this end_user_id")
+    args = parser.parse_args()
+    if args.command == "rebuild":
+        rebuild(args.user)
+
+
+if __name__ == "__main__":
+    main()
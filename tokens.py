@@ -0,0 +1,173 @@
+"""This module contains the access token service
+
+Keys are parsed once, when the app starts, into python-jose key objects and kept
+in a key set indexed by kid, so a request only pays for the signature check.
+Tokens carry the end_user_id and the user's token version, which lets the
+request path resolve the user by primary key (or, with AUTH_STATELESS, not at
+all) instead of looking them up by email.
+
+Access tokens are short lived and renewed with rotating refresh tokens. Revoked
+access tokens are listed by jti in an in-process set that a background task
+reloads from the database, so checking one never costs a query.
+"""
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+from jose import jwk, jws
+from jose.backends.base import Key
+from jose.constants import ALGORITHMS
+from jose.exceptions import JOSEError
+
+load_dotenv()
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM", ALGORITHMS.HS256)
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", "30"))
+# PEM text or a path to a PEM file, only used with the RS / ES / PS algorithms
+JWT_PRIVATE_KEY = os.getenv("JWT_PRIVATE_KEY")
+JWT_PUBLIC_KEY = os.getenv("JWT_PUBLIC_KEY")
+JWT_KEY_ID = os.getenv("JWT_KEY_ID", "primary")
+# JSON object of kid -> public key (or secret) still accepted while keys are rotated
+JWT_PREVIOUS_KEYS = os.getenv("JWT_PREVIOUS_KEYS", "{}")
+# Trust the email and username inside the token instead of loading the user on every request
+AUTH_STATELESS = os.getenv("AUTH_STATELESS", "false").strip().lower() in ("1", "true", "yes", "on")
+
+
+class TokenClaims(NamedTuple):
+    user_id: int
+    version: int
+    expires_at: int
+    jti: str | None = None
+    email: str | None = None
+    username: str | None = None
+
+
+class KeySet(NamedTuple):
+    signing_key: Key
+    verify_keys: dict
+
+
+_key_set: KeySet | None = None
+_revoked: frozenset = frozenset()
+# Revoked here but maybe not yet in the last reload, kept until a reload that started later has finished
+_revoked_locally: dict[str, float] = {}
+_revoked_lock = threading.Lock()
+
+
+def _read_pem(value: str | None) -> str | None:
+    if value and not value.lstrip().startswith("-----") and os.path.isfile(value):
+        with open(value) as pem_file:
+            return pem_file.read()
+    return value
+
+
+def load_key_set() -> KeySet:
+    """This function checks the token configuration and builds the key set, failing loudly if it is unusable."""
+    global _key_set
+    if ALGORITHM in ALGORITHMS.HMAC:
+        if not SECRET_KEY:
+            raise RuntimeError(f"SECRET_KEY must be set to sign tokens with {ALGORITHM}")
+        signing_key = jwk.construct(SECRET_KEY, ALGORITHM)
+        verify_key = signing_key
+    elif ALGORITHM in ALGORITHMS.SUPPORTED:
+        private_pem = _read_pem(JWT_PRIVATE_KEY)
+        if not private_pem:
+            raise RuntimeError(f"JWT_PRIVATE_KEY must be set to sign tokens with {ALGORITHM}")
+        try:
+            signing_key = jwk.construct(private_pem, ALGORITHM)
+            public_pem = _read_pem(JWT_PUBLIC_KEY)
+            verify_key = jwk.construct(public_pem, ALGORITHM) if public_pem else signing_key.public_key()
+        except JOSEError as error:
+            raise RuntimeError(f"Unusable JWT key for {ALGORITHM}: {error}") from error
+    else:
+        # python-jose has no EdDSA support, Ed25519 keys would need a different JWT library
+        raise RuntimeError(f"Unsupported ALGORITHM {ALGORITHM!r}, expected one of {sorted(ALGORITHMS.SUPPORTED)}")
+
+    verify_keys = {JWT_KEY_ID: verify_key}
+    try:
+        previous_keys = json.loads(JWT_PREVIOUS_KEYS)
+        for kid, key in previous_keys.items():
+            verify_keys.setdefault(kid, jwk.construct(_read_pem(key), ALGORITHM))
+    except (ValueError, AttributeError, JOSEError) as error:
+        raise RuntimeError(f"JWT_PREVIOUS_KEYS is not a usable JSON object of keys: {error}") from error
+
+    _key_set = KeySet(signing_key, verify_keys)
+    return _key_set
+
+
+def _keys() -> KeySet:
+    return _key_set or load_key_set()
+
+
+def create_access_token(end_user_id: int, token_version: int, email: str, username: str) -> str:
+    """This function signs an access token for a user."""
+    now = int(time.time())
+    claims = {
+        "sub": str(end_user_id),
+        "ver": token_version,
+        "jti": secrets.token_urlsafe(12),
+        "iat": now,
+        "exp": now + ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+    if AUTH_STATELESS:
+        claims["email"] = email
+        claims["name"] = username
+    return jws.sign(claims, _keys().signing_key, headers={"kid": JWT_KEY_ID}, algorithm=ALGORITHM)
+
+
+def verify_access_token(token: str) -> TokenClaims | None:
+    """This function checks the signature and expiry of a token and returns its claims, None if it is not valid."""
+    # Only the claims the app relies on are checked, which skips most of jwt.decode's generic validation
+    key_set = _keys()
+    try:
+        key = key_set.verify_keys.get(jws.get_unverified_header(token).get("kid", JWT_KEY_ID))
+        if key is None:
+            return None
+        claims = json.loads(jws.verify(token, key, algorithms=[ALGORITHM]))
+        if claims["exp"] <= time.time():
+            return None
+        return TokenClaims(int(claims["sub"]), int(claims.get("ver", 0)), claims["exp"], claims.get("jti"),
+                           claims.get("email"), claims.get("name"))
+    except (JOSEError, ValueError, KeyError, TypeError):
+        return None
+
+
+def new_refresh_token() -> tuple[str, str]:
+    """This function returns a fresh opaque refresh token and the hash that is stored for it."""
+    token = secrets.token_urlsafe(32)
+    return token, hash_refresh_token(token)
+
+
+def hash_refresh_token(token: str) -> str:
+    # The token is 256 random bits, a fast hash is enough to make the stored value useless if leaked
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def is_revoked(jti: str | None) -> bool:
+    return jti is not None and jti in _revoked
+
+
+def revoke_locally(jti: str):
+    """This function makes a revocation visible in this process right away, other processes see it on reload."""
+    global _revoked
+    with _revoked_lock:
+        _revoked_locally[jti] = time.monotonic()
+        _revoked = _revoked | {jti}
+
+
+def replace_revoked(jtis: set[str], loaded_since: float):
+    """This function swaps in the revocation list read from the database by a reload started at loaded_since."""
+    global _revoked
+    with _revoked_lock:
+        for jti, revoked_at in list(_revoked_locally.items()):
+            if revoked_at < loaded_since:
+                del _revoked_locally[jti]
+        _revoked = frozenset(jtis).union(_revoked_locally)